@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+"""Benchmarks for PSF model evaluation.
+
+Run with ``python benchmarks/bench_psf.py [name ...]``, where each name is
+one of the benchmarks listed by ``--list``. With no names, all benchmarks
+are run. cubefit must be installed; from a source checkout (with the
+extension built in place), run with ``PYTHONPATH=.`` from the repository
+root instead.
+"""
+
+from __future__ import print_function, division
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import timeit
+
+import numpy as np
+
+import cubefit
+from cubefit.main import snf_tied_params
+from cubefit.psffuncs import gaussian_moffat_psf
+
+MODEL_SHAPE = (32, 32)
+DATA_SHAPE = (15, 15)
+NW = 800  # a typical number of wavelengths (B channel ~779, R ~1572)
+
+
+def psf_params(nw):
+    """SNFactory-like Gaussian + Moffat parameters at `nw` wavelengths."""
+    alpha = np.linspace(2.2, 1.8, nw)
+    sigma = 0.545 + 0.215 * alpha
+    beta = 1.685 + 0.345 * alpha
+    ellip = 1.6 * np.ones(nw)
+    eta = 1.04 * np.ones(nw)
+    yctr = np.linspace(-1., 1., nw)
+    xctr = np.linspace(0.5, -0.5, nw)
+    return sigma, alpha, beta, ellip, eta, yctr, xctr
+
+
+def timeit_min(func, number=5, repeat=3):
+    """Best time per call of `func`, in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def bench_threads(nw=NW):
+    """evaluate_galaxy time versus number of FFT threads."""
+
+    A = gaussian_moffat_psf(*psf_params(nw), shape=MODEL_SHAPE, subpix=3)
+    galaxy = np.random.rand(nw, MODEL_SHAPE[0], MODEL_SHAPE[1])
+
+    print("evaluate_galaxy, nw={}".format(nw))
+    print("threads   time [ms]   speedup")
+    t1 = None
+    for threads in sorted(set([1, 2, 4, 8, 16, 32,
+                               cubefit.psf.default_threads(nw)])):
+        psf = cubefit.TabularPSF(A, threads=threads)
+        t = timeit_min(lambda: psf.evaluate_galaxy(galaxy, DATA_SHAPE,
+                                                   (0.5, -0.5)))
+        if t1 is None:
+            t1 = t
+        print("{:7d}   {:9.2f}   {:7.2f}".format(threads, 1000. * t, t1 / t))
+
+
+def bench_adjoint(nw=NW):
+    """gradient_helper (adjoint) time compared to evaluate_galaxy."""
+
+    A = gaussian_moffat_psf(*psf_params(nw), shape=MODEL_SHAPE, subpix=3)
+    psf = cubefit.TabularPSF(A, threads=1)
+    galaxy = np.random.rand(nw, MODEL_SHAPE[0], MODEL_SHAPE[1])
+    x = np.random.rand(nw, DATA_SHAPE[0], DATA_SHAPE[1])
+
+    t_eval = timeit_min(lambda: psf.evaluate_galaxy(galaxy, DATA_SHAPE,
+                                                    (0.5, -0.5)))
+    t_adj = timeit_min(lambda: psf.gradient_helper(x, DATA_SHAPE,
+                                                   (0.5, -0.5)))
+
+    print("nw={}, threads=1".format(nw))
+    print("evaluate_galaxy   {:8.2f} ms".format(1000. * t_eval))
+    print("gradient_helper   {:8.2f} ms".format(1000. * t_adj))
+
+
+def bench_sampling(nw=NW // 2):
+    """FFT versus partial-DFT sampling for various model/data shapes."""
+
+    print("evaluate_galaxy and gradient_helper, nw={}, threads=1".format(nw))
+    print("model  data   evaluate [ms]    adjoint [ms]   auto")
+    print("               fft     dft     fft     dft")
+    for n in (32, 48, 64):
+        A = gaussian_moffat_psf(*psf_params(nw), shape=(n, n), subpix=1)
+        galaxy = np.random.rand(nw, n, n)
+        psfs = [cubefit.TabularPSF(A, threads=1, sampling=sampling)
+                for sampling in ('fft', 'dft')]
+        autopsf = cubefit.TabularPSF(A, threads=1, sampling='auto')
+        for m in (5, 10, 15, 20):
+            x = np.random.rand(nw, m, m)
+            times = []
+            for psf in psfs:
+                times.append(timeit_min(lambda: psf.evaluate_galaxy(
+                    galaxy, (m, m), (0.5, -0.5))))
+            for psf in psfs:
+                times.append(timeit_min(lambda: psf.gradient_helper(
+                    x, (m, m), (0.5, -0.5))))
+            auto = "dft" if autopsf._use_dft((m, m)) else "fft"
+            print("{:5d}  {:4d}  {:6.2f}  {:6.2f}  {:6.2f}  {:6.2f}   {}"
+                  .format(n, m, *([1000. * t for t in times] + [auto])))
+
+
+def bench_grad_batching(nw=NW):
+    """Inverse FFTs for value + gradient: one (3, nw) plan or 3 x nw."""
+
+    from cubefit.psf import FFTWorkspace
+
+    shape = (nw,) + MODEL_SHAPE
+    print("inverse FFTs of value and 2 derivatives, nw={}".format(nw))
+    print("threads   batched [ms]   3 x nw [ms]")
+    for threads in sorted(set([1, cubefit.psf.default_threads(nw)])):
+        ws3 = FFTWorkspace((3,) + shape, np.float64, threads, "FFTW_MEASURE")
+        ws = FFTWorkspace(shape, np.float64, threads, "FFTW_MEASURE")
+        ws3.fftout[...] = np.random.rand(*ws3.fftout.shape)
+        ws.fftout[...] = np.random.rand(*ws.fftout.shape)
+
+        def run_separate():
+            for i in range(3):
+                ws.ifft.execute()
+
+        t3 = timeit_min(ws3.ifft.execute)
+        t = timeit_min(run_separate)
+        print("{:7d}   {:12.2f}   {:11.2f}".format(threads, 1000. * t3,
+                                                   1000. * t))
+
+
+def _baseline_kernel():
+    """`gaussian_moffat_psf` of `psffuncs_baseline.pyx` (the compiled
+    kernel before the value/gradient split), or None if it cannot be
+    compiled."""
+    try:
+        import pyximport
+        pyximport.install(setup_args={'include_dirs': np.get_include()})
+        from psffuncs_baseline import gaussian_moffat_psf as baseline
+    except Exception as e:
+        print("baseline kernel not available: {}".format(e))
+        return None
+    return baseline
+
+
+def bench_kernel(nw=NW):
+    """gaussian_moffat_psf time for each method of pixel integration.
+
+    For subpixel sampling, the kernel from before the value/gradient
+    split (benchmarks/psffuncs_baseline.pyx, compiled with pyximport) is
+    timed alongside the current one.
+    """
+
+    params = psf_params(nw)
+    baseline = _baseline_kernel()
+    print("gaussian_moffat_psf, nw={}, shape={}, threads=1".format(
+        nw, MODEL_SHAPE))
+    print("subpix   value before/after [ms]   value+grad before/after [ms]")
+    for subpix in (1, 3, 5):
+        times = []
+        for func in (baseline, gaussian_moffat_psf):
+            for grad in (False, True):
+                if func is None:
+                    times.append(float('nan'))
+                    continue
+                times.append(timeit_min(lambda: func(
+                    *params, shape=MODEL_SHAPE, subpix=subpix, grad=grad)))
+        print("{:6d}   {:11.2f} / {:9.2f}   {:16.2f} / {:9.2f}".format(
+            subpix, *[1000. * t for t in
+                      (times[0], times[2], times[1], times[3])]))
+
+    t = timeit_min(lambda: gaussian_moffat_psf(
+        *params, shape=MODEL_SHAPE, method='integrate'))
+    tgrad = timeit_min(lambda: gaussian_moffat_psf(
+        *params, shape=MODEL_SHAPE, method='integrate', grad=True))
+    print("method='integrate'")
+    print("         {:10.2f}   {:15.2f}".format(1000. * t, 1000. * tgrad))
+
+    print("method='adaptive'")
+    print("   tol   value [ms]   value+grad [ms]")
+    for tol in (1.e-2, 1.e-3, 1.e-4):
+        t = timeit_min(lambda: gaussian_moffat_psf(
+            *params, shape=MODEL_SHAPE, method='adaptive', tol=tol))
+        tgrad = timeit_min(lambda: gaussian_moffat_psf(
+            *params, shape=MODEL_SHAPE, method='adaptive', tol=tol,
+            grad=True))
+        print("{:6.0e}   {:10.2f}   {:15.2f}".format(tol, 1000. * t,
+                                                  1000. * tgrad))
+
+
+def bench_templates(nw=NW):
+    """PSFTemplates interpolation versus gaussian_moffat_psf evaluation."""
+
+    sigma, alpha, beta, ellip, eta, yctr, xctr = psf_params(nw)
+    templates = cubefit.PSFTemplates(snf_tied_params)
+    t = timeit_min(lambda: templates.evaluate(alpha, ellip, yctr, xctr,
+                                              (1, 1)), number=1, repeat=1)
+    print("PSFTemplates: {:d} templates built in {:.2f} ms".format(
+        len(templates), 1000. * t))
+
+    print("nw={}, threads=1".format(nw))
+    print("shape      grad   templates [ms]   subpix=3 [ms]   integrate [ms]")
+    for shape, grad in ((MODEL_SHAPE, False), (DATA_SHAPE, True)):
+        times = [timeit_min(lambda: templates.evaluate(
+            alpha, ellip, yctr, xctr, shape, grad=grad))]
+        for kwargs in ({'subpix': 3}, {'method': 'integrate'}):
+            times.append(timeit_min(lambda: gaussian_moffat_psf(
+                sigma, alpha, beta, ellip, eta, yctr, xctr, shape, grad=grad,
+                **kwargs)))
+        print("{:8s}   {:4s}   {:14.2f}   {:13.2f}   {:14.2f}".format(
+            "{}x{}".format(*shape), str(grad), *[1000. * t for t in times]))
+
+    A = templates.evaluate(alpha, ellip, yctr, xctr, DATA_SHAPE)
+    B = gaussian_moffat_psf(sigma, alpha, beta, ellip, eta, yctr, xctr,
+                            DATA_SHAPE, method='integrate')
+    C = gaussian_moffat_psf(sigma, alpha, beta, ellip, eta, yctr, xctr,
+                            DATA_SHAPE, subpix=3)
+    print("max error relative to peak (vs integrate): templates {:.1e}, "
+          "subpix=3 {:.1e}".format(np.max(np.abs(A - B)) / np.max(B),
+                                   np.max(np.abs(C - B)) / np.max(B)))
+
+
+def bench_point_source(nw=NW):
+    """GaussianMoffatPSF.point_source: analytic versus Fourier shift."""
+
+    sigma, alpha, beta, ellip, eta, yctr, xctr = psf_params(nw)
+    pos = (0.3, -0.4)
+    ctr = (0.2, 0.1)
+
+    print("point_source with grad=True, nw={}, shape={}, threads=1".format(
+        nw, DATA_SHAPE))
+    print("analytic [ms]   fourier [ms]")
+    psf = cubefit.GaussianMoffatPSF(sigma, alpha, beta, ellip, eta, yctr,
+                                    xctr, MODEL_SHAPE, subpix=3, threads=1)
+    times = [timeit_min(lambda: psf.point_source(pos, DATA_SHAPE, ctr,
+                                                 grad=True, fourier=fourier))
+             for fourier in (False, True)]
+    print("{:13.2f}   {:12.2f}".format(*[1000. * t for t in times]))
+
+    # The Fourier shift is exact only for band-limited PSFs, so the error
+    # depends on the PSF width.
+    print("max error relative to peak, method='integrate', nw=8")
+    print("alpha   value     gradient")
+    for a in (1.5, 2.0, 2.5, 3.0, 4.0):
+        alpha = a * np.ones(8)
+        sigma = 0.545 + 0.215 * alpha
+        beta = 1.685 + 0.345 * alpha
+        psf = cubefit.GaussianMoffatPSF(
+            sigma, alpha, beta, ellip[:8], eta[:8], yctr[:8], xctr[:8],
+            MODEL_SHAPE, method='integrate', threads=1)
+        A, Agrad = psf.point_source(pos, DATA_SHAPE, ctr, grad=True)
+        B, Bgrad = psf.point_source(pos, DATA_SHAPE, ctr, grad=True,
+                                    fourier=True)
+        peak = np.max(A)
+        print("{:5.1f}   {:.1e}   {:.1e}".format(
+            a, np.max(np.abs(A - B)) / peak,
+            np.max(np.abs(Agrad - Bgrad)) / peak))
+
+
+def bench_backends(nw=NW):
+    """Compiled versus NumPy implementations of gaussian_moffat_psf."""
+
+    from cubefit import _psffuncs, _psffuncs_numpy
+
+    params = psf_params(nw)
+    print("gaussian_moffat_psf, nw={}, shape={}, threads=1".format(
+        nw, MODEL_SHAPE))
+    print("                    compiled [ms]        numpy [ms]")
+    print("method              value    +grad    value    +grad")
+    for name, kwargs in (("subpix=1", {'subpix': 1}),
+                         ("subpix=3", {'subpix': 3}),
+                         ("integrate", {'method': 'integrate'}),
+                         ("adaptive", {'method': 'adaptive'})):
+        times = [timeit_min(lambda: mod.gaussian_moffat_psf(
+                     *params, shape=MODEL_SHAPE, grad=grad, threads=1,
+                     **kwargs), number=1)
+                 for mod in (_psffuncs, _psffuncs_numpy)
+                 for grad in (False, True)]
+        print("{:16s} {:8.1f} {:8.1f} {:8.1f} {:8.1f}".format(
+            name, *[1000. * t for t in times]))
+
+
+def bench_compress(nw=NW):
+    """Compressed PSF storage: memory, speed and accuracy."""
+
+    params = psf_params(nw)
+    galaxy = np.random.rand(nw, MODEL_SHAPE[0], MODEL_SHAPE[1])
+    psf = cubefit.GaussianMoffatPSF(*params, shape=MODEL_SHAPE, subpix=3,
+                                    threads=1)
+    g = psf.evaluate_galaxy(galaxy, DATA_SHAPE, (0.5, -0.5))
+    t = timeit_min(lambda: psf.evaluate_galaxy(galaxy, DATA_SHAPE,
+                                               (0.5, -0.5)))
+
+    print("nw={}, threads=1".format(nw))
+    print("    tol   rank   memory [kB]   evaluate_galaxy [ms]   max error")
+    print("   none   {:4d}   {:11.0f}   {:20.2f}".format(
+        nw, psf.fftconv.nbytes / 1024., 1000. * t))
+    for tol in (1.e-3, 1.e-4, 1.e-5):
+        cpsf = cubefit.GaussianMoffatPSF(*params, shape=MODEL_SHAPE,
+                                         subpix=3, threads=1, compress=tol)
+        lr = cpsf._fftconv_lr
+        gc = cpsf.evaluate_galaxy(galaxy, DATA_SHAPE, (0.5, -0.5))
+        t = timeit_min(lambda: cpsf.evaluate_galaxy(galaxy, DATA_SHAPE,
+                                                    (0.5, -0.5)))
+        print("{:7.0e}   {:4d}   {:11.0f}   {:20.2f}   {:9.1e}".format(
+            tol, lr.rank, lr.nbytes / 1024., 1000. * t,
+            np.max(np.abs(gc - g)) / np.max(np.abs(g))))
+
+
+def bench_truncate(nw=NW):
+    """gaussian_moffat_psf on large grids, with and without truncation."""
+
+    params = psf_params(nw)
+    print("gaussian_moffat_psf, nw={}, subpix=3, threads=1".format(nw))
+    print("(max error relative to peak; flux error is max |sum - 1|)")
+    print("   shape   truncate   time [ms]   max error   flux error")
+    for n in (32, 64, 128):
+        shape = (n, n)
+        A = gaussian_moffat_psf(*params, shape=shape, subpix=3)
+        for truncate in (None, 1.e-4, 1.e-5, 1.e-6):
+            B = gaussian_moffat_psf(*params, shape=shape, subpix=3,
+                                    truncate=truncate)
+            t = timeit_min(lambda: gaussian_moffat_psf(
+                *params, shape=shape, subpix=3, truncate=truncate),
+                           number=2)
+            print("{:>8s}   {:>8s}   {:9.1f}   {:9.1e}   {:10.1e}".format(
+                "{}x{}".format(n, n) if truncate is None else "",
+                "none" if truncate is None else "{:.0e}".format(truncate),
+                1000. * t, np.max(np.abs(B - A)) / np.max(A),
+                np.max(np.abs(B.sum(axis=(1, 2)) - 1.))))
+
+
+def bench_epoch_threads(nw=NW, nepochs=8):
+    """Multi-epoch chi^2 (chisq_galaxy_sky_multi) versus epoch threads."""
+
+    from multiprocessing.pool import ThreadPool
+    from cubefit.fitting import chisq_galaxy_sky_multi
+
+    A = gaussian_moffat_psf(*psf_params(nw), shape=MODEL_SHAPE, subpix=3)
+    psfs = [cubefit.TabularPSF(A, threads=1) for _ in range(nepochs)]
+    galaxy = np.random.rand(nw, MODEL_SHAPE[0], MODEL_SHAPE[1])
+    datas = [np.random.rand(nw, DATA_SHAPE[0], DATA_SHAPE[1])
+             for _ in range(nepochs)]
+    weights = [np.ones_like(data) for data in datas]
+    ctrs = [(0.1 * i, -0.1 * i) for i in range(nepochs)]
+
+    print("chisq_galaxy_sky_multi, nw={}, nepochs={}, FFT threads=1".format(
+        nw, nepochs))
+    print("epoch threads   time [ms]   speedup")
+    t1 = timeit_min(lambda: chisq_galaxy_sky_multi(galaxy, datas, weights,
+                                                   ctrs, psfs))
+    print("{:>13s}   {:9.1f}   {:7.2f}".format("none", 1000. * t1, 1.))
+    for n in sorted(set([1, 2, 4, cubefit.psf.default_threads(nepochs)])):
+        pool = ThreadPool(n)
+        t = timeit_min(lambda: chisq_galaxy_sky_multi(
+            galaxy, datas, weights, ctrs, psfs, executor=pool))
+        pool.close()
+        print("{:13d}   {:9.1f}   {:7.2f}".format(n, 1000. * t, t1 / t))
+
+
+def bench_sn_fit(nw=NW // 4, nepochs=8):
+    """fit_position_sky_sn_multi: joint versus block method."""
+
+    from multiprocessing.pool import ThreadPool
+    from cubefit.fitting import fit_position_sky_sn_multi
+
+    A = gaussian_moffat_psf(*psf_params(nw), shape=MODEL_SHAPE, subpix=3)
+    psf = cubefit.TabularPSF(A, threads=1)
+    ctrs = [(0.3 * i - 1., 0.5 - 0.2 * i) for i in range(nepochs)]
+    snctr = (1.3, -0.7)
+    y, x = np.mgrid[-15.5:16., -15.5:16.]
+    galaxy = np.exp(-0.5 * ((y - 1.)**2 + x**2) / 16.)
+    galaxy = np.broadcast_to(galaxy, (nw,) + MODEL_SHAPE).copy()
+    datas = []
+    for ctr in ctrs:
+        data = (psf.evaluate_galaxy(galaxy, DATA_SHAPE, ctr) +
+                2. * psf.point_source(snctr, DATA_SHAPE, ctr) + 0.1)
+        datas.append(data + 0.01 * np.random.randn(*data.shape))
+    weights = [np.ones_like(data) for data in datas]
+    bounds = nepochs * [(-3., 3.)]
+
+    def fit(**kwargs):
+        return fit_position_sky_sn_multi(
+            galaxy, datas, weights, [c[0] + 0.2 for c in ctrs],
+            [c[1] - 0.2 for c in ctrs], (1., -0.5), nepochs * [psf], 1.e7,
+            bounds, bounds, (-3., 3.), **kwargs)
+
+    print("fit_position_sky_sn_multi, nw={}, nepochs={}, FFT threads=1"
+          .format(nw, nepochs))
+    print("method   epoch threads   time [s]   SN position")
+    for method, n in [('joint', None), ('block', None)] + [
+            ('block', n) for n in
+            sorted(set([2, cubefit.psf.default_threads(nepochs)]))]:
+        pool = None if n is None else ThreadPool(n)
+        t = timeit_min(lambda: fit(method=method, executor=pool), number=1,
+                       repeat=1)
+        res = fit(method=method, executor=pool)
+        if pool is not None:
+            pool.close()
+        print("{:6s}   {:>13s}   {:8.2f}   ({:.4f}, {:.4f})".format(
+            method, "none" if n is None else str(n), t, *res[2]))
+
+
+BENCHMARKS = OrderedDict([("threads", bench_threads),
+                          ("adjoint", bench_adjoint),
+                          ("sampling", bench_sampling),
+                          ("grad_batching", bench_grad_batching),
+                          ("kernel", bench_kernel),
+                          ("templates", bench_templates),
+                          ("point_source", bench_point_source),
+                          ("backends", bench_backends),
+                          ("compress", bench_compress),
+                          ("truncate", bench_truncate),
+                          ("epoch_threads", bench_epoch_threads),
+                          ("sn_fit", bench_sn_fit)])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", help="benchmarks to run")
+    parser.add_argument("--list", action="store_true",
+                        help="list available benchmarks")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, func in BENCHMARKS.items():
+            print("{:12s} {}".format(name, func.__doc__))
+    else:
+        np.random.seed(0)
+        for name in (args.names or BENCHMARKS):
+            BENCHMARKS[name]()
+            print()
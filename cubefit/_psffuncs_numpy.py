@@ -0,0 +1,433 @@
+"""Vectorized NumPy implementation of the PSF kernels in `_psffuncs`.
+
+This is used by `cubefit.psffuncs` when the compiled extension is not
+available. The functions have the same signatures and give the same
+results (to rounding). They are up to about twice as slow as the
+compiled functions on one thread, and are not multi-threaded (the
+`threads` arguments are ignored). Wavelength slices are processed in
+chunks to bound the size of temporary arrays.
+"""
+
+from __future__ import division
+
+import numpy as np
+from scipy.special import erf, erfc
+
+__all__ = ["gaussian_moffat_psf", "template_psf"]
+
+# Maximum number of elements in temporary arrays.
+CHUNK_SIZE = 2**21
+
+# Gauss-Legendre rules (nodes, weights) for method='integrate', of order
+# 6, 3, 2 and 1, and thresholds on the squared distance (in units of the
+# Moffat width) below which each is used. See `_gl_rule` in
+# `_psffuncs.pyx`.
+GL_RULES = [np.polynomial.legendre.leggauss(n) for n in (6, 3, 2, 1)]
+GL_THRESHOLDS = (2.25, 9., 36., np.inf)
+
+MAX_ADAPTIVE_SUBPIX = 128
+
+# Number of taps in the (Lagrange) interpolation of templates.
+NTAPS = 4
+
+
+def _chunks(nw, size):
+    """Slices over `nw` wavelengths with at most CHUNK_SIZE elements,
+    for `size` elements per wavelength."""
+    step = max(CHUNK_SIZE // max(size, 1), 1)
+    return [slice(k, min(k + step, nw)) for k in range(0, nw, step)]
+
+
+def _slice_params(sigma, alpha, beta, ellipticity, eta):
+    """Squared Gaussian and Moffat widths in y and x for each wavelength,
+    and the normalization of ``m + eta * g`` integrated over area."""
+
+    # We are defining, in the Gaussian,
+    # sigma_x^2 / sigma_y^2 === ellipticity
+    # and in the Moffat,
+    # alpha_x^2 / alpha_y^2 === ellipticity
+    sigma_y = sigma / np.sqrt(ellipticity)
+    alpha_y = alpha / np.sqrt(ellipticity)
+
+    gnorm = 1. / (2. * np.pi * sigma * sigma_y)
+    mnorm = (beta - 1.) / (np.pi * alpha * alpha_y)
+    norm = 1. / (1. / mnorm + eta / gnorm)
+
+    return sigma_y**2, sigma**2, alpha_y**2, alpha**2, norm
+
+
+def _centers(n, ctr):
+    """Coordinates of pixel centers along one axis relative to the PSF
+    center, shape (nw, n), for centers `ctr` relative to the array
+    center."""
+    return np.arange(n) - (ctr[:, None] + (n - 1) / 2.)
+
+
+def _sample(c, subpix):
+    """Subpixel coordinates, shape (nw, n, subpix), for pixel centers
+    `c`."""
+    return c[:, :, None] - 0.5 + (np.arange(subpix) + 0.5) / subpix
+
+
+def _moffat_sum(y, x, ay2, ax2, beta, grad):
+    """Sum the Moffat (and, if grad, its derivatives with respect to the
+    center, without constant factors) over the last axis of `y` and `x`.
+
+    `y` has shape (nw, ny, q), `x` has shape (nw, nx, r) and the other
+    arguments shape (nw,)."""
+
+    b = -beta[:, None, None, None, None]
+    base = (1. + y[:, :, :, None, None]**2 / ay2[:, None, None, None, None] +
+            x[:, None, None, :, :]**2 / ax2[:, None, None, None, None])
+    if not grad:
+        return np.sum(base**b, axis=(2, 4))
+
+    sm1 = base**(b - 1.)
+    m = np.sum(sm1 * base, axis=(2, 4))
+    mdy = np.einsum('kjqir,kjq->kji', sm1, y)
+    mdx = np.einsum('kjqir,kir->kji', sm1, x)
+    return m, mdy, mdx
+
+
+def _slices_sample(sigma, alpha, beta, ellipticity, eta, yctr, xctr, shape,
+                   subpix, grad):
+    """method='sample' for one chunk of wavelengths."""
+
+    ny, nx = shape
+    sy2, sx2, ay2, ax2, norm = _slice_params(sigma, alpha, beta,
+                                             ellipticity, eta)
+    norm = norm / subpix**2
+    y = _sample(_centers(ny, yctr), subpix)
+    x = _sample(_centers(nx, xctr), subpix)
+
+    # The Gaussian is separable.
+    ey = np.exp(-y**2 / (2. * sy2[:, None, None]))
+    ex = np.exp(-x**2 / (2. * sx2[:, None, None]))
+    gy = ey.sum(axis=2)
+    gx = ex.sum(axis=2)
+    g = gy[:, :, None] * gx[:, None, :]
+
+    n = norm[:, None, None]
+    e = eta[:, None, None]
+    if not grad:
+        m = _moffat_sum(y, x, ay2, ax2, beta, False)
+        return n * (m + e * g)
+
+    m, mdy, mdx = _moffat_sum(y, x, ay2, ax2, beta, True)
+    gdy = ((ey * y).sum(axis=2)[:, :, None] * gx[:, None, :] /
+           sy2[:, None, None])
+    gdx = (gy[:, :, None] * (ex * x).sum(axis=2)[:, None, :] /
+           sx2[:, None, None])
+    b = beta[:, None, None]
+    return (n * (m + e * g),
+            n * (2. * b / ay2[:, None, None] * mdy + e * gdy),
+            n * (2. * b / ax2[:, None, None] * mdx + e * gdx))
+
+
+def _gaussian_integrals(c, s2):
+    """Integral of the 1-d Gaussian (without normalization) over pixels
+    centered at `c`, and its derivative with respect to the center."""
+
+    s = 1. / (np.sqrt(2.) * np.sqrt(s2))[:, None]
+    gscale = np.sqrt(0.5 * np.pi * s2)[:, None]
+    lo = (c - 0.5) * s
+    hi = (c + 0.5) * s
+
+    # (erfc on either side of the center to avoid cancellation)
+    gi = np.where(lo > 0., erfc(lo) - erfc(hi),
+                  np.where(hi < 0., erfc(-hi) - erfc(-lo),
+                           erf(hi) - erf(lo)))
+    return gscale * gi, np.exp(-lo**2) - np.exp(-hi**2)
+
+
+def _slices_integrate(sigma, alpha, beta, ellipticity, eta, yctr, xctr,
+                      shape, grad):
+    """method='integrate' for one chunk of wavelengths."""
+
+    ny, nx = shape
+    nw = len(sigma)
+    sy2, sx2, ay2, ax2, norm = _slice_params(sigma, alpha, beta,
+                                             ellipticity, eta)
+    cy = _centers(ny, yctr)
+    cx = _centers(nx, xctr)
+
+    giy, gdy = _gaussian_integrals(cy, sy2)
+    gix, gdx = _gaussian_integrals(cx, sx2)
+
+    # Moffat: Gauss-Legendre quadrature with an order depending on the
+    # distance of the pixel from the center; pixels are grouped by order.
+    u2 = (cy[:, :, None]**2 / ay2[:, None, None] +
+          cx[:, None, :]**2 / ax2[:, None, None])
+    m = np.empty((nw, ny, nx))
+    if grad:
+        mdy = np.empty((nw, ny, nx))
+        mdx = np.empty((nw, ny, nx))
+    lower = -np.inf
+    for (nodes, weights), upper in zip(GL_RULES, GL_THRESHOLDS):
+        k, j, i = np.nonzero((u2 >= lower) & (u2 < upper))
+        lower = upper
+        if len(k) == 0:
+            continue
+        b = -beta[k, None, None]
+        yy = (cy[k, j, None] + 0.5 * nodes)**2 / ay2[k, None]
+        xx = (cx[k, i, None] + 0.5 * nodes)**2 / ax2[k, None]
+        sm = (1. + yy[:, :, None] + xx[:, None, :])**b
+        m[k, j, i] = np.einsum('pqr,q,r->p', sm, weights, weights)
+
+        if grad:
+            # 1-d integrals along opposite pixel edges.
+            ylo = (cy[k, j] - 0.5)**2 / ay2[k]
+            yhi = (cy[k, j] + 0.5)**2 / ay2[k]
+            xlo = (cx[k, i] - 0.5)**2 / ax2[k]
+            xhi = (cx[k, i] + 0.5)**2 / ax2[k]
+            b = b[:, :, 0]
+            mdy[k, j, i] = np.dot((1. + ylo[:, None] + xx)**b -
+                                  (1. + yhi[:, None] + xx)**b, weights)
+            mdx[k, j, i] = np.dot((1. + yy + xlo[:, None])**b -
+                                  (1. + yy + xhi[:, None])**b, weights)
+
+    n = norm[:, None, None]
+    e = eta[:, None, None]
+    value = n * (0.25 * m + e * giy[:, :, None] * gix[:, None, :])
+    if not grad:
+        return value
+    return (value,
+            n * (0.5 * mdy + e * gdy[:, :, None] * gix[:, None, :]),
+            n * (0.5 * mdx + e * giy[:, :, None] * gdx[:, None, :]))
+
+
+def _curvature(y, x, sy2, sx2, ay2, ax2, beta, eta):
+    """Sum of the absolute second derivatives (in y and x) of each
+    component of ``m + eta * g`` at (y, x)."""
+
+    gb = np.exp(-(y**2 / (2. * sy2) + x**2 / (2. * sx2)))
+    gyy = gb * (y**2 / sy2 - 1.) / sy2
+    gxx = gb * (x**2 / sx2 - 1.) / sx2
+
+    b = 1. + y**2 / ay2 + x**2 / ax2
+    p1 = b**(-beta - 1.)
+    p2 = p1 / b
+    myy = -2. * beta * p1 / ay2 + 4. * beta * (beta + 1.) * p2 * y**2 / ay2**2
+    mxx = -2. * beta * p1 / ax2 + 4. * beta * (beta + 1.) * p2 * x**2 / ax2**2
+
+    return np.abs(myy) + np.abs(mxx) + eta * (np.abs(gyy) + np.abs(gxx))
+
+
+def _slices_adaptive(sigma, alpha, beta, ellipticity, eta, yctr, xctr, shape,
+                     tol, grad):
+    """method='adaptive' for one chunk of wavelengths."""
+
+    ny, nx = shape
+    nw = len(sigma)
+    sy2, sx2, ay2, ax2, norm = _slice_params(sigma, alpha, beta,
+                                             ellipticity, eta)
+    cy = np.broadcast_to(_centers(ny, yctr)[:, :, None], (nw, ny, nx))
+    cx = np.broadcast_to(_centers(nx, xctr)[:, None, :], (nw, ny, nx))
+    p = [a[:, None, None] for a in (sy2, sx2, ay2, ax2, beta, eta)]
+
+    # Number of subpixels per axis in each pixel (see `_adaptive_subpix`
+    # in `_psffuncs.pyx`), from the curvature at the pixel center and at
+    # the point of the pixel closest to the center.
+    y = np.sign(cy) * np.maximum(np.abs(cy) - 0.5, 0.)
+    x = np.sign(cx) * np.maximum(np.abs(cx) - 0.5, 0.)
+    curv = np.maximum(_curvature(y, x, *p), _curvature(cy, cx, *p))
+    subpix = np.ceil(np.sqrt(curv / (24. * tol * (1. + p[5]))))
+    subpix = np.clip(subpix, 1, MAX_ADAPTIVE_SUBPIX).astype(np.intp)
+
+    # g, m and (if grad) gdy, gdx, mdy, mdx for each pixel.
+    res = np.empty((6 if grad else 2, nw, ny, nx))
+    for s in np.unique(subpix):
+        k, j, i = np.nonzero(subpix == s)
+        for sl in _chunks(len(k), s * s):
+            kk, jj, ii = k[sl], j[sl], i[sl]
+            sy2k, sx2k, ay2k, ax2k = sy2[kk], sx2[kk], ay2[kk], ax2[kk]
+            yq = _sample(cy[kk, jj, ii][:, None], s)[:, 0]  # (npix, s)
+            xq = _sample(cx[kk, jj, ii][:, None], s)[:, 0]
+            ey = np.exp(-yq**2 / (2. * sy2k[:, None]))
+            ex = np.exp(-xq**2 / (2. * sx2k[:, None]))
+            gy = ey.sum(axis=1)
+            gx = ex.sum(axis=1)
+            b = -beta[kk, None, None]
+            base = (1. + yq[:, :, None]**2 / ay2k[:, None, None] +
+                    xq[:, None, :]**2 / ax2k[:, None, None])
+
+            area = 1. / (s * s)
+            res[0, kk, jj, ii] = gy * gx * area
+            if not grad:
+                res[1, kk, jj, ii] = np.sum(base**b, axis=(1, 2)) * area
+                continue
+            sm1 = base**(b - 1.)
+            res[1, kk, jj, ii] = np.sum(sm1 * base, axis=(1, 2)) * area
+            res[2, kk, jj, ii] = (ey * yq).sum(axis=1) * gx / sy2k * area
+            res[3, kk, jj, ii] = gy * (ex * xq).sum(axis=1) / sx2k * area
+            res[4, kk, jj, ii] = (2. * beta[kk] / ay2k * area *
+                                  np.einsum('pqr,pq->p', sm1, yq))
+            res[5, kk, jj, ii] = (2. * beta[kk] / ax2k * area *
+                                  np.einsum('pqr,pr->p', sm1, xq))
+
+    n = norm[:, None, None]
+    e = p[5]
+    value = n * (res[1] + e * res[0])
+    if not grad:
+        return value
+    return value, n * (res[4] + e * res[2]), n * (res[5] + e * res[3])
+
+
+def _truncation(sigma, alpha, beta, eta, truncate):
+    """Squared radius of the truncation ellipse, in units of the Moffat
+    width, and the tail normalization factor. See `_truncation` in
+    `_psffuncs.pyx`."""
+
+    if not 0. < truncate < 1.:
+        raise ValueError("truncate must be between 0 and 1")
+
+    r2 = alpha**2 / sigma**2
+    u2max = np.maximum(truncate**(-1. / beta) - 1.,
+                       -2. * np.log(truncate) / r2)
+    fm = 1. / (beta - 1.)
+    fg = 2. * eta / r2
+    tail = (fm * (1. + u2max)**(1. - beta) +
+            fg * np.exp(-0.5 * u2max * r2)) / (fm + fg)
+
+    return u2max, 1. / (1. - tail)
+
+
+def gaussian_moffat_psf(sigma, alpha, beta, ellipticity, eta, yctr, xctr,
+                        shape, subpix=1, grad=False, threads=1,
+                        method='sample', tol=1.e-4, truncate=None):
+    """Evaluate a gaussian+moffat function on each slice of a 3-d grid.
+
+    See `cubefit.psffuncs.gaussian_moffat_psf`. `threads` is ignored.
+    With `truncate`, all pixels are evaluated and those outside the
+    truncation ellipse are then zeroed.
+    """
+
+    if method not in ('sample', 'integrate', 'adaptive'):
+        raise ValueError("unknown method: " + repr(method))
+    if method == 'adaptive' and not tol > 0.:
+        raise ValueError("tol must be positive")
+
+    args = [np.asarray(a, dtype=np.float64)
+            for a in (sigma, alpha, beta, ellipticity, eta, yctr, xctr)]
+    nw = len(args[0])
+    ny, nx = shape
+
+    out = np.empty((nw, ny, nx), dtype=np.float64)
+    if grad:
+        outgrad = np.empty((2, nw, ny, nx), dtype=np.float64)
+
+    if method == 'sample':
+        size = ny * nx * subpix**2 * (3 if grad else 1)
+    elif method == 'integrate':
+        size = ny * nx * 36 * (3 if grad else 1)
+    else:
+        size = ny * nx * 8  # (pixels are further chunked by subpix)
+
+    for sl in _chunks(nw, size):
+        chunk = [a[sl] for a in args]
+        if method == 'sample':
+            res = _slices_sample(*chunk, shape=shape, subpix=subpix,
+                                 grad=grad)
+        elif method == 'integrate':
+            res = _slices_integrate(*chunk, shape=shape, grad=grad)
+        else:
+            res = _slices_adaptive(*chunk, shape=shape, tol=tol, grad=grad)
+
+        if grad:
+            out[sl], outgrad[0, sl], outgrad[1, sl] = res
+        else:
+            out[sl] = res
+
+    if truncate is not None:
+        sigma, alpha, beta, ellipticity, eta, yctr, xctr = args
+        u2max, scale = _truncation(sigma, alpha, beta, eta, truncate)
+        cy = _centers(ny, yctr)
+        cx = _centers(nx, xctr)
+        u2 = ((cy**2 * ellipticity[:, None])[:, :, None] +
+              cx[:, None, :]**2) / alpha[:, None, None]**2
+        scale = np.where(u2 <= u2max[:, None, None], scale[:, None, None], 0.)
+        out *= scale
+        if grad:
+            outgrad *= scale
+
+    if grad:
+        return out, outgrad
+    return out
+
+
+def _axis_taps(n, ctr, oversample, ntmpl):
+    """Interpolation taps along one axis for `template_psf`: template
+    indices (``ntmpl`` if beyond the template), Lagrange weights and
+    their derivatives with respect to the template coordinate, each with
+    shape (nw, n, NTAPS). See `_axis_taps` in `_psffuncs.pyx`."""
+
+    u = (np.arange(n) - (ctr[:, None] + (n - 1) / 2.)) * oversample
+    f = np.floor(u)
+    t = u - f
+
+    offsets = np.arange(NTAPS) - NTAPS // 2 + 1
+    w = np.empty(t.shape + (NTAPS,))
+    dw = np.empty(t.shape + (NTAPS,))
+    for a in range(NTAPS):
+        others = [m for m in range(NTAPS) if m != a]
+        den = np.prod([a - m for m in others])
+        w[..., a] = np.prod([t - offsets[m] for m in others], axis=0) / den
+        dw[..., a] = sum(np.prod([t - offsets[l] for l in others if l != m],
+                                 axis=0)
+                         for m in others) / den
+
+    idx = np.abs(f.astype(np.intp)[..., None] + offsets)
+    idx[idx >= ntmpl] = ntmpl
+    return idx, w, dw
+
+
+def template_psf(templates, nodes, coeffs, yctr, xctr, shape, oversample,
+                 grad=False, threads=1):
+    """Evaluate a PSF on each slice of a 3-d grid by interpolating
+    precomputed templates.
+
+    See `cubefit.psffuncs.template_psf`. `threads` is ignored.
+    """
+
+    yctr = np.asarray(yctr, dtype=np.float64)
+    xctr = np.asarray(xctr, dtype=np.float64)
+    nodes = np.asarray(nodes)
+    coeffs = np.asarray(coeffs)
+    nw = len(yctr)
+    ny, nx = shape
+    if (nodes.shape[0] != nw or coeffs.shape[0] != nw or
+            coeffs.shape[1] != nodes.shape[1] or len(xctr) != nw):
+        raise ValueError("shapes of nodes, coeffs, yctr, xctr must match")
+    if np.any(nodes >= len(templates)):
+        raise ValueError("node index out of range")
+
+    # Pad templates with zeros, for taps beyond their extent.
+    ntmpl = templates.shape[1]
+    padded = np.zeros((len(templates), ntmpl + 1, ntmpl + 1))
+    padded[:, :ntmpl, :ntmpl] = templates
+
+    yidx, yw, ydw = _axis_taps(ny, yctr, oversample, ntmpl)
+    xidx, xw, xdw = _axis_taps(nx, xctr, oversample, ntmpl)
+
+    out = np.empty((nw, ny, nx), dtype=np.float64)
+    if grad:
+        outgrad = np.empty((2, nw, ny, nx), dtype=np.float64)
+
+    m = nodes.shape[1]
+    for sl in _chunks(nw, m * ny * nx * NTAPS**2):
+        # (nw, m, ny, NTAPS, nx, NTAPS)
+        t = padded[nodes[sl, :, None, None, None, None],
+                   yidx[sl, None, :, :, None, None],
+                   xidx[sl, None, None, None, :, :]]
+        t = np.einsum('km,kmjaib->kjaib', coeffs[sl], t)
+        out[sl] = np.einsum('kjaib,kja,kib->kji', t, yw[sl], xw[sl])
+        if grad:
+            # (d/dctr = -oversample * d/du)
+            outgrad[0, sl] = -oversample * np.einsum(
+                'kjaib,kja,kib->kji', t, ydw[sl], xw[sl])
+            outgrad[1, sl] = -oversample * np.einsum(
+                'kjaib,kja,kib->kji', t, yw[sl], xdw[sl])
+
+    if grad:
+        return out, outgrad
+    return out
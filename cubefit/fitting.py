@@ -2,24 +2,27 @@ from __future__ import print_function, division
 
 import copy
 import logging
+import multiprocessing
+import threading
 
 import numpy as np
 from scipy.optimize import fmin_l_bfgs_b
 
 __all__ = ["guess_sky", "fit_galaxy_single", "fit_galaxy_sky_multi",
-           "fit_position_sky", "fit_position_sky_sn_multi",
-           "RegularizationPenalty"]
+           "fit_position_sky", "fit_position_sky_pool",
+           "fit_position_sky_sn_multi", "RegularizationPenalty"]
 
 
-def _check_result(warnflag, msg):
-    """Check result of fmin_l_bfgs_b()"""
+def _check_result(warnflag, msg, fn="fmin_l_bfgs_b"):
+    """Check result of fmin_l_bfgs_b() (or another optimizer `fn` returning
+    the same warnflag)"""
     if warnflag == 0:
         return
     if warnflag == 1:
         raise RuntimeError("too many function calls or iterations "
-                           "in fmin_l_bfgs_b()")
+                           "in %s()" % fn)
     if warnflag == 2:
-        raise RuntimeError("fmin_l_bfgs_b() exited with warnflag=2: %s" % msg)
+        raise RuntimeError("%s() exited with warnflag=2: %s" % (fn, msg))
     raise RuntimeError("unknown warnflag: %s" % warnflag)
 
 
@@ -164,8 +167,8 @@ def sky_and_sn(data, weight, g, s, ggrad=None, sgrad=None):
         sngradnum = -D*dB + dE*C + dF*B + F*dB - dG*C
         ddenom = dA*C - 2.*B*dB
 
-        skygrad = (skygradnum + sky * ddenom) / denom
-        sngrad = (sngradnum + sn * ddenom) / denom
+        skygrad = (skygradnum - sky * ddenom) / denom
+        sngrad = (sngradnum - sn * ddenom) / denom
 
         return sky, sn, skygrad, sngrad
 
@@ -173,6 +176,15 @@ def sky_and_sn(data, weight, g, s, ggrad=None, sgrad=None):
         return sky, sn
 
 
+def _map(executor, func, items):
+    """List of ``func(item)`` for each of `items`, computed with
+    ``executor.map`` or, if `executor` is None, serially."""
+
+    if executor is None:
+        return [func(item) for item in items]
+    return list(executor.map(func, items))
+
+
 def chisq_galaxy_single(galaxy, data, weight, ctr, psf):
     """Chi^2 and gradient (not including regularization term) for a single
     epoch."""
@@ -180,48 +192,95 @@ def chisq_galaxy_single(galaxy, data, weight, ctr, psf):
     scene = psf.evaluate_galaxy(galaxy, data.shape[1:3], ctr)
     r = data - scene
     wr = weight * r
-    val = np.sum(wr * r)
+    val = np.sum(wr * r, dtype=np.float64)
     grad = psf.gradient_helper(-2. * wr, data.shape[1:3], ctr)
 
     return val, grad
 
 
-def chisq_galaxy_sky_single(galaxy, data, weight, ctr, psf):
-    """Chi^2 and gradient (not including regularization term) for 
-    single epoch, allowing sky to float."""
+def _chisq_sky(data, weight, g):
+    """Chi^2, allowing sky to float, for a single epoch given the galaxy
+    model `g` evaluated on the data grid. Also returns the gradient of
+    chi^2 with respect to `g`."""
 
-    g = psf.evaluate_galaxy(galaxy, data.shape[1:3], ctr)
     sky = determine_sky(data, weight, g)
     scene = sky[:, None, None] + g
 
     r = data - scene
     wr = weight * r
-    val = np.sum(wr * r)
+    val = np.sum(wr * r, dtype=np.float64)
 
     # See note in docs/gradient.tex for the (non-trivial) derivation
     # of this gradient!
     tmp = np.sum(wr, axis=(1, 2)) / np.sum(weight, axis=(1, 2))
     vtwr = weight * tmp[:, None, None]
-    grad = psf.gradient_helper(-2. * (wr - vtwr), data.shape[1:3], ctr)
 
-    return val, grad
+    return val, -2. * (wr - vtwr)
 
 
-def chisq_galaxy_sky_multi(galaxy, datas, weights, ctrs, psfs):
+def chisq_galaxy_sky_single(galaxy, data, weight, ctr, psf):
     """Chi^2 and gradient (not including regularization term) for 
-    multiple epochs, allowing sky to float."""
+    single epoch, allowing sky to float."""
 
-    val = 0.0
-    grad = np.zeros_like(galaxy)
-    for data, weight, ctr, psf in zip(datas, weights, ctrs, psfs):
-        epochval, epochgrad = chisq_galaxy_sky_single(galaxy, data, weight,
-                                                      ctr, psf)
-        val += epochval
-        grad += epochgrad
+    g = psf.evaluate_galaxy(galaxy, data.shape[1:3], ctr)
+    val, dval_dg = _chisq_sky(data, weight, g)
+    grad = psf.gradient_helper(dval_dg, data.shape[1:3], ctr)
 
     return val, grad
 
 
+def chisq_galaxy_sky_multi(galaxy, datas, weights, ctrs, psfs,
+                           executor=None):
+    """Chi^2 and gradient (not including regularization term) for 
+    multiple epochs, allowing sky to float.
+
+    If `executor` (e.g., a `multiprocessing.pool.ThreadPool` or
+    `concurrent.futures.ThreadPoolExecutor`) is given, epochs are
+    evaluated concurrently with its ``map`` method. It must run tasks in
+    threads of this process: FFTs release the GIL, so epochs evaluated
+    in different threads run in parallel."""
+
+    # The galaxy model is the same for all epochs, so we Fourier transform
+    # it only once. Likewise, gradient contributions from all epochs are
+    # summed in Fourier space and inverse transformed only once at the end.
+    fftgal = psfs[0].fft_galaxy(galaxy)
+
+    if executor is None:
+        fftgrad = np.zeros_like(fftgal)
+        val = 0.0
+        for data, weight, ctr, psf in zip(datas, weights, ctrs, psfs):
+            g = psf.evaluate_galaxy_fft(fftgal, data.shape[1:3], ctr)
+            epochval, dval_dg = _chisq_sky(data, weight, g)
+            psf.gradient_helper_fft(dval_dg, data.shape[1:3], ctr, fftgrad)
+            val += epochval
+
+        return val, psfs[0].ifft_galaxy(fftgrad)
+
+    # Each thread sums the gradient contributions of the epochs it
+    # evaluates into its own array; these are summed at the end.
+    local = threading.local()
+    fftgrads = []
+
+    def epoch_chisq(args):
+        data, weight, ctr, psf = args
+        fftgrad = getattr(local, 'fftgrad', None)
+        if fftgrad is None:
+            fftgrad = local.fftgrad = np.zeros_like(fftgal)
+            fftgrads.append(fftgrad)
+        g = psf.evaluate_galaxy_fft(fftgal, data.shape[1:3], ctr)
+        epochval, dval_dg = _chisq_sky(data, weight, g)
+        psf.gradient_helper_fft(dval_dg, data.shape[1:3], ctr, fftgrad)
+        return epochval
+
+    vals = _map(executor, epoch_chisq, list(zip(datas, weights, ctrs, psfs)))
+
+    fftgrad = fftgrads[0]
+    for other in fftgrads[1:]:
+        fftgrad += other
+
+    return sum(vals), psfs[0].ifft_galaxy(fftgrad)
+
+
 def chisq_position_sky(ctr, galaxy, data, weight, psf):
     """chisq and gradient for fit_position_sky"""
 
@@ -233,8 +292,9 @@ def chisq_position_sky(ctr, galaxy, data, weight, psf):
     dscene = skygrad[:, :, None, None] + ggrad
 
     diff = data - scene
-    chisq = np.sum(weight * diff**2)
-    chisqgrad = -2. * np.sum(weight * diff * dscene, axis=(1, 2, 3))
+    chisq = np.sum(weight * diff**2, dtype=np.float64)
+    chisqgrad = -2. * np.sum(weight * diff * dscene, axis=(1, 2, 3),
+                             dtype=np.float64)
 
     logging.debug("(%f, %f) chisq=%f", ctr[0], ctr[1], chisq)
 
@@ -281,7 +341,7 @@ def fit_galaxy_single(galaxy0, data, weight, ctr, psf, regpenalty, factor):
 
 
 def fit_galaxy_sky_multi(galaxy0, datas, weights, ctrs, psfs, regpenalty,
-                         factor):
+                         factor, executor=None):
     """Fit the galaxy model to multiple data cubes.
 
     Parameters
@@ -290,15 +350,23 @@ def fit_galaxy_sky_multi(galaxy0, datas, weights, ctrs, psfs, regpenalty,
         Initial galaxy model.
     datas : list of ndarray
         Sky-subtracted data for each epoch to fit.
+    executor : object, optional
+        Thread pool with a ``map`` method, used to evaluate epochs
+        concurrently. See `chisq_galaxy_sky_multi`.
     """
 
     nepochs = len(datas)
+    epochs = list(zip(datas, weights, ctrs, psfs))
+
+    def epoch_chisq(galaxy):
+        """Function of one epoch giving its chi^2 for `galaxy`."""
+        def func(args):
+            data, weight, ctr, psf = args
+            return chisq_galaxy_sky_single(galaxy, data, weight, ctr, psf)[0]
+        return func
 
     # Get initial chisq values for info output.
-    cvals = []
-    for data, weight, ctr, psf in zip(datas, weights, ctrs, psfs):
-        cval, _ = chisq_galaxy_sky_single(galaxy0, data, weight, ctr, psf)
-        cvals.append(cval)
+    cvals = _map(executor, epoch_chisq(galaxy0), epochs)
 
     logging.info(u"        initial \u03C7\u00B2/epoch: [%s]",
                  ", ".join(["%8.2f" % v for v in cvals]))
@@ -310,7 +378,7 @@ def fit_galaxy_sky_multi(galaxy0, datas, weights, ctrs, psfs, regpenalty,
         # galparams is 1-d (raveled version of galaxy); reshape to 3-d.
         galaxy = galparams.reshape(galaxy0.shape)
         cval, cgrad = chisq_galaxy_sky_multi(galaxy, datas, weights,
-                                             ctrs, psfs)
+                                             ctrs, psfs, executor=executor)
         rval, rgrad = regpenalty(galaxy)
 
         totval = cval + rval
@@ -327,21 +395,18 @@ def fit_galaxy_sky_multi(galaxy0, datas, weights, ctrs, psfs, regpenalty,
     galaxy = galparams.reshape(galaxy0.shape)
 
     # Get final chisq values.
-    cvals = []
-    for data, weight, ctr, psf in zip(datas, weights, ctrs, psfs):
-        cval, _ = chisq_galaxy_sky_single(galaxy, data, weight, ctr, psf)
-        cvals.append(cval)
+    cvals = _map(executor, epoch_chisq(galaxy), epochs)
     logging.info(u"        final   \u03C7\u00B2/epoch: [%s]",
                  ", ".join(["%8.2f" % v for v in cvals]))
 
     _log_result("fmin_l_bfgs_b", f, d['nit'], d['funcalls'])
 
     # get last-calculated skys, given galaxy.
-    skys = []
-    for data, weight, ctr, psf in zip(datas, weights, ctrs, psfs):
+    def epoch_sky(args):
+        data, weight, ctr, psf = args
         scene = psf.evaluate_galaxy(galaxy, data.shape[1:3], ctr)
-        sky = np.average(data - scene, weights=weight, axis=(1, 2))
-        skys.append(sky)
+        return np.average(data - scene, weights=weight, axis=(1, 2))
+    skys = _map(executor, epoch_sky, epochs)
 
     return galaxy, skys
 
@@ -368,9 +433,14 @@ def fit_position_sky(galaxy, data, weight, ctr0, psf, bounds):
         Fitted sky.
     """
 
-    ctr, f, d = fmin_l_bfgs_b(chisq_position_sky, ctr0,
-                              args=(galaxy, data, weight, psf),
-                              iprint=0, callback=None, bounds=bounds)
+    # The galaxy model is fixed, so it only needs to be convolved once.
+    psf.cache_galaxy(galaxy)
+    try:
+        ctr, f, d = fmin_l_bfgs_b(chisq_position_sky, ctr0,
+                                  args=(galaxy, data, weight, psf),
+                                  iprint=0, callback=None, bounds=bounds)
+    finally:
+        psf.clear_galaxy_cache()
     _check_result(d['warnflag'], d['task'])
     _log_result("fmin_l_bfgs_b", f, d['nit'], d['funcalls'])
 
@@ -381,12 +451,129 @@ def fit_position_sky(galaxy, data, weight, ctr0, psf, bounds):
     return tuple(ctr), sky
 
 
-def chisq_position_sky_sn_multi(allctrs, galaxy, datas, weights, psfs):
+# Galaxy model shared with the worker processes of `fit_position_sky_pool`
+# (set in each worker by `_init_shared_galaxy`).
+_shared_galaxy = None
+
+
+def _init_shared_galaxy(buf, shape, dtype):
+    """Pool initializer: view the shared buffer `buf` as the galaxy."""
+    global _shared_galaxy
+    _shared_galaxy = np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+
+def _fit_position_sky_shared(args):
+    """`fit_position_sky` of one epoch with the shared galaxy model."""
+    return fit_position_sky(_shared_galaxy, *args)
+
+
+def fit_position_sky_pool(galaxy, datas, weights, ctrs0, psfs, bounds,
+                          processes=None):
+    """Fit data position and sky for several epochs independently (fixed
+    galaxy model), in a pool of worker processes.
+
+    Parameters
+    ----------
+    galaxy : ndarray (3-d)
+    datas, weights : list of ndarray (3-d)
+    ctrs0 : list of (float, float)
+        Initial center of each epoch.
+    psfs : list of PSF
+    bounds : list of [(float, float), (float, float)]
+        Bounds for each epoch. See `fit_position_sky`.
+    processes : int, optional
+        Number of worker processes. Default is the number of CPUs. If 1,
+        epochs are fit in this process.
+
+    Returns
+    -------
+    ctrs : list of (float, float)
+    skys : list of ndarray (1-d)
+        Fitted center and sky of each epoch, in the order of `datas`.
+
+    Notes
+    -----
+    The galaxy model is copied once into shared memory, which the
+    workers read directly; only the data, PSF and bounds of each epoch
+    are sent to the worker fitting it.
+    """
+
+    tasks = list(zip(datas, weights, ctrs0, psfs, bounds))
+    if processes is None:
+        processes = min(multiprocessing.cpu_count(), len(tasks))
+
+    if processes <= 1 or len(tasks) <= 1:
+        results = [fit_position_sky(galaxy, *task) for task in tasks]
+    else:
+        galaxy = np.ascontiguousarray(galaxy)
+        buf = multiprocessing.RawArray('c', galaxy.nbytes)
+        np.frombuffer(buf, dtype=galaxy.dtype)[:] = galaxy.ravel()
+        pool = multiprocessing.Pool(processes, _init_shared_galaxy,
+                                    (buf, galaxy.shape, galaxy.dtype.str))
+        try:
+            results = pool.map(_fit_position_sky_shared, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    ctrs = [ctr for ctr, _ in results]
+    skys = [sky for _, sky in results]
+    return ctrs, skys
+
+
+def _chisq_sky_sn(data, weight, g, ggrad, s, sgrad, hess=False):
+    """Chi^2 of a single epoch with sky and SN flux fit for, given the
+    galaxy `g` and SN `s` evaluated on the data grid, and its gradient
+    with respect to the parameters of `ggrad` and `sgrad` (each of shape
+    (nparams, nw, ny, nx)). If `hess` is True, also return the
+    Gauss-Newton approximation of the Hessian, (nparams, nparams)."""
+
+    sky, sn, skygrad, sngrad = sky_and_sn(data, weight, g, s,
+                                          ggrad=ggrad, sgrad=sgrad)
+
+    scene = sky[:, None, None] + g + sn[:, None, None] * s
+    diff = data - scene
+    chisq = np.sum(weight * diff**2, dtype=np.float64)
+
+    dscene = (skygrad[:, :, None, None] + ggrad +
+              sngrad[:, :, None, None] * s + sn[:, None, None] * sgrad)
+    dchisq = -2. * np.sum(weight * diff * dscene, axis=(1, 2, 3),
+                          dtype=np.float64)
+
+    if hess:
+        n = len(dscene)
+        dscene = dscene.reshape(n, -1).astype(np.float64)
+        d2chisq = 2. * np.dot(weight.reshape(1, -1) * dscene, dscene.T)
+        return chisq, dchisq, d2chisq
+
+    return chisq, dchisq
+
+
+def _chisq_position_sky_sn(ctr, snctr, galaxy, data, weight, psf, fourier,
+                           hess=False):
+    """Chi^2 of a single epoch and its gradient (and, optionally,
+    Gauss-Newton Hessian) with respect to
+    (ctr[0], ctr[1], snctr[0], snctr[1])."""
+
+    g, ggrad = psf.evaluate_galaxy(galaxy, data.shape[1:3], ctr, grad=True)
+    s, sgrad = psf.point_source(snctr, data.shape[1:3], ctr, grad=True,
+                                fourier=fourier)
+
+    # add galaxy gradient with SN position
+    ggrad = np.vstack((ggrad, np.zeros_like(ggrad)))
+
+    return _chisq_sky_sn(data, weight, g, ggrad, s, sgrad, hess=hess)
+
+
+def chisq_position_sky_sn_multi(allctrs, galaxy, datas, weights, psfs,
+                                fourier=False):
     """Function to minimize. `allctrs` is a 1-d ndarray:
 
     [yctr[0], xctr[0], yctr[1], xctr[1], ..., snyctr, snxctr]
 
     where the indicies are
+
+    `fourier` is passed to the PSFs' `point_source`.
     """
 
     nepochs = len(datas)
@@ -399,29 +586,13 @@ def chisq_position_sky_sn_multi(allctrs, galaxy, datas, weights, psfs):
     chisqgrad = np.zeros_like(allctrs)
 
     for i in range(nepochs):
-        data = datas[i]
-        weight = weights[i]
-        psf = psfs[i]
         ctr_ind = slice(2*i, 2*i+2)
         ctr = tuple(allctrs[ctr_ind])
 
-        g, ggrad = psf.evaluate_galaxy(galaxy, data.shape[1:3], ctr, grad=True)
-        s, sgrad = psf.point_source(snctr, data.shape[1:3], ctr, grad=True)
-
-        # add galaxy gradient with SN position
-        ggrad = np.vstack((ggrad, np.zeros_like(ggrad)))
-
-        sky, sn, skygrad, sngrad = sky_and_sn(data, weight, g, s,
-                                              ggrad=ggrad, sgrad=sgrad)
-
-        scene = sky[:, None, None] + g + sn[:, None, None] * s
-        diff = data - scene
-        chisq += np.sum(weight * diff**2)
-
-        # gradient on chisq for this epoch with position and sn position
-        dscene = (skygrad[:, :, None, None] + ggrad +
-                  sngrad[:, :, None, None] * s + sn[:, None, None] * sgrad)
-        dchisq = -2. * np.sum(weight * diff * dscene, axis=(1, 2, 3))
+        # chisq for this epoch and gradient with position and sn position
+        epochchisq, dchisq = _chisq_position_sky_sn(
+            ctr, snctr, galaxy, datas[i], weights[i], psfs[i], fourier)
+        chisq += epochchisq
 
         # add gradient to right place in chisqgrad
         chisqgrad[ctr_ind] += dchisq[0:2]
@@ -430,9 +601,128 @@ def chisq_position_sky_sn_multi(allctrs, galaxy, datas, weights, psfs):
     return chisq, chisqgrad
 
 
+def _fit_position_sky_sn_block(allctrs0, galaxy, datas, weights, psfs,
+                               bounds, factor, fourier, executor, maxiter):
+    """Minimize the sum of `_chisq_position_sky_sn` over epochs with
+    Levenberg-Marquardt steps that exploit the block structure of the
+    problem.
+
+    Each epoch's chi^2 depends only on its own position c_i and the SN
+    position s, so the (Gauss-Newton) Hessian is zero except for 2x2
+    blocks A_i (c_i, c_i), B_i (c_i, s) and C_i (s, s). An iteration
+    (1) evaluates the chi^2, gradient and blocks of all epochs, which
+    are independent, and (2) solves the 2x2 Schur complement system
+    ``(sum C_i - B_i^T A_i^-1 B_i) ds = -sum (g_s,i - B_i^T A_i^-1 g_c,i)``
+    for the SN step from these cached blocks, then ``A_i dc_i = -(g_c,i
+    + B_i ds)`` for each epoch step. The galaxy model is thus evaluated
+    once per epoch and iteration.
+
+    Bounds are handled with an active set: parameters that sit on a
+    bound with the gradient pointing out of the feasible region are
+    held fixed (removed from the 2x2 solves and the Schur system), and
+    the step in the remaining parameters is projected onto the bounds.
+
+    Arguments are as in `fit_position_sky_sn_multi`, with `allctrs0`
+    and `bounds` in the order of `chisq_position_sky_sn_multi`. Returns
+    the fitted positions, the final chi^2 and a dictionary of
+    information like that of `fmin_l_bfgs_b`: 'warnflag', 'task', 'nit'
+    and 'funcalls' (number of evaluations of all epochs, as for the
+    objective of `fmin_l_bfgs_b`).
+    """
+
+    nepochs = len(datas)
+    eps = np.finfo(np.float64).eps
+    tasks = list(range(nepochs))
+    lo = bounds[:, 0]
+    hi = bounds[:, 1]
+
+    def evaluate(allctrs):
+        """Total chi^2, and the gradient and Hessian of each epoch."""
+        snctr = tuple(allctrs[2*nepochs:2*nepochs+2])
+
+        def epoch(i):
+            return _chisq_position_sky_sn(
+                tuple(allctrs[2*i:2*i+2]), snctr, galaxy, datas[i],
+                weights[i], psfs[i], fourier, hess=True)
+        res = _map(executor, epoch, tasks)
+        return (sum(r[0] for r in res), [r[1] for r in res],
+                [r[2] for r in res])
+
+    def step(grads, hesses, lam, free):
+        """Damped Gauss-Newton step for the free positions.
+
+        Fixed parameters get a zero step: their rows and columns of the
+        Hessian blocks are replaced by those of the identity and their
+        gradient is zeroed, which decouples them from the rest.
+        """
+        dallctrs = np.empty(2*nepochs + 2, dtype=np.float64)
+        snfree = free[2*nepochs:2*nepochs+2]
+        schur = np.zeros((2, 2))
+        rhs = np.zeros(2)
+        solves = []
+        for i, (grad, hess) in enumerate(zip(grads, hesses)):
+            mask = np.concatenate((free[2*i:2*i+2], snfree))
+            hess = np.where(np.outer(mask, mask), hess, np.diag(~mask))
+            grad = np.where(mask, grad, 0.)
+            a = hess[0:2, 0:2] + lam * np.diag(np.diag(hess[0:2, 0:2]))
+            b = hess[0:2, 2:4]
+            ainvb = np.linalg.solve(a, b)
+            ainvg = np.linalg.solve(a, grad[0:2])
+            schur += hess[2:4, 2:4] - np.dot(b.T, ainvb)
+            rhs += grad[2:4] - np.dot(b.T, ainvg)
+            solves.append((ainvb, ainvg))
+        schur += lam * np.diag(np.diag(schur))
+        dsnctr = np.linalg.solve(schur, -rhs)
+        for i, (ainvb, ainvg) in enumerate(solves):
+            dallctrs[2*i:2*i+2] = -(ainvg + np.dot(ainvb, dsnctr))
+        dallctrs[2*nepochs:2*nepochs+2] = dsnctr
+        return dallctrs
+
+    def free_params(allctrs, grads):
+        """Mask of parameters not held at a bound by the gradient."""
+        grad = np.zeros(2*nepochs + 2, dtype=np.float64)
+        for i, g in enumerate(grads):
+            grad[2*i:2*i+2] += g[0:2]
+            grad[2*nepochs:2*nepochs+2] += g[2:4]
+        return ~(((allctrs <= lo) & (grad > 0.)) |
+                 ((allctrs >= hi) & (grad < 0.)))
+
+    allctrs = np.clip(np.array(allctrs0, dtype=np.float64), lo, hi)
+    f, grads, hesses = evaluate(allctrs)
+    funcalls = 1
+    lam = 1.e-3
+    info = {'warnflag': 1, 'task': 'maximum number of iterations',
+            'nit': maxiter}
+
+    for nit in range(1, maxiter + 1):
+        # Increase damping until chi^2 decreases. Stop (at the same
+        # relative tolerance as fmin_l_bfgs_b) when it no longer does
+        # by a significant amount.
+        free = free_params(allctrs, grads)
+        while True:
+            trial = np.clip(allctrs + step(grads, hesses, lam, free), lo, hi)
+            ftrial, tgrads, thesses = evaluate(trial)
+            funcalls += 1
+            if ftrial < f or lam > 1.e10:
+                break
+            lam *= 10.
+
+        converged = f - ftrial <= factor * eps * max(abs(f), abs(ftrial), 1.)
+        if ftrial < f:
+            allctrs, f, grads, hesses = trial, ftrial, tgrads, thesses
+            lam = max(lam / 10., 1.e-12)
+        if converged:
+            info = {'warnflag': 0, 'task': 'CONVERGENCE', 'nit': nit}
+            break
+
+    info['funcalls'] = funcalls
+    return allctrs, f, info
+
+
 def fit_position_sky_sn_multi(galaxy, datas, weights, yctr0, xctr0, snctr0,
                               psfs, factor, yctrbounds, xctrbounds,
-                              snctrbounds):
+                              snctrbounds, fourier=False, method='joint',
+                              executor=None, maxiter=100):
     """Fit data pointing (nepochs), SN position (in model frame),
     SN amplitude (nepochs), and sky level (nepochs). This is meant to be
     used only on epochs with SN light.
@@ -450,6 +740,25 @@ def fit_position_sky_sn_multi(galaxy, datas, weights, yctr0, xctr0, snctr0,
     relbound : float
         Bound on positions relative to initial positions. Bounds will
         be ``(intial - relbound, initial + relbound)``.
+    fourier : bool, optional
+        During the fit, evaluate the SN by shifting the tabulated PSF in
+        Fourier space rather than evaluating the analytic PSF (see
+        `GaussianMoffatPSF.point_source`). This is faster, but less
+        accurate for narrow PSFs. The final sky and SN spectra always
+        use the default evaluation.
+    method : {'joint', 'block'}, optional
+        'joint' (default) fits all positions at once with
+        `fmin_l_bfgs_b`. 'block' uses Levenberg-Marquardt steps
+        decomposed into independent per-epoch terms and a 2x2 system for
+        the SN position (see `_fit_position_sky_sn_block`). It converges
+        to the same minimum with several times fewer evaluations of the
+        galaxy model, and the per-epoch evaluations can be done
+        concurrently.
+    executor : object, optional
+        Thread pool with a ``map`` method, used by the 'block' method to
+        evaluate epochs concurrently. See `chisq_galaxy_sky_multi`.
+    maxiter : int, optional
+        Maximum number of iterations of the 'block' method.
 
     Returns
     -------
@@ -471,6 +780,9 @@ def fit_position_sky_sn_multi(galaxy, datas, weights, yctr0, xctr0, snctr0,
     each iteration.
     """
 
+    if method not in ('joint', 'block'):
+        raise ValueError("unknown method: " + repr(method))
+
     nepochs = len(datas)
     assert len(weights) == len(yctr0) == len(xctr0) == len(psfs) == nepochs
 
@@ -495,12 +807,28 @@ def fit_position_sky_sn_multi(galaxy, datas, weights, yctr0, xctr0, snctr0,
     callback(bounds)
     logging.debug('')
 
-    fallctrs, f, d = fmin_l_bfgs_b(chisq_position_sky_sn_multi, allctrs0,
-                                   args=(galaxy, datas, weights, psfs),
-                                   iprint=0, callback=callback, bounds=bounds,
-                                   factr=factor)
-    _check_result(d['warnflag'], d['task'])
-    _log_result("fmin_l_bfgs_b", f, d['nit'], d['funcalls'])
+    # The galaxy model is fixed, so it only needs to be convolved once
+    # for each epoch.
+    for psf in psfs:
+        psf.cache_galaxy(galaxy)
+    try:
+        if method == 'joint':
+            fallctrs, f, d = fmin_l_bfgs_b(
+                chisq_position_sky_sn_multi, allctrs0,
+                args=(galaxy, datas, weights, psfs, fourier), iprint=0,
+                callback=callback, bounds=bounds, factr=factor)
+        else:
+            fallctrs, f, d = _fit_position_sky_sn_block(
+                allctrs0, galaxy, datas, weights, psfs, bounds, factor,
+                fourier, executor, maxiter)
+            callback(fallctrs)
+    finally:
+        for psf in psfs:
+            psf.clear_galaxy_cache()
+    fn = ("fmin_l_bfgs_b" if method == 'joint' else
+          "_fit_position_sky_sn_block")
+    _check_result(d['warnflag'], d['task'], fn)
+    _log_result(fn, f, d['nit'], d['funcalls'])
 
     # pull out fitted positions
     fyctr = fallctrs[0:2*nepochs:2].copy()
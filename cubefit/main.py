@@ -10,16 +10,18 @@ import glob
 import json
 import logging
 import math
+from multiprocessing.pool import ThreadPool
 import os
 
 import numpy as np
 
 from .version import __version__
 from .psffuncs import gaussian_moffat_psf
-from .psf import TabularPSF, GaussianMoffatPSF
+from .psf import (TabularPSF, GaussianMoffatPSF, PSFTemplates,
+                  set_planner_effort, load_wisdom, default_threads)
 from .io import read_datacube, write_results, read_results
 from .fitting import (guess_sky, fit_galaxy_single, fit_galaxy_sky_multi,
-                      fit_position_sky, fit_position_sky_sn_multi,
+                      fit_position_sky_pool, fit_position_sky_sn_multi,
                       RegularizationPenalty)
 from .utils import yxbounds
 from .extern import ADR, Hyper_PSF3D_PL
@@ -35,9 +37,23 @@ LBFGSB_FACTOR = 1e10
 REFWAVE = 5000.  # reference wavelength in Angstroms for PSF params and ADR
 POSITION_BOUND = 3.  # Bound on fitted positions relative in initial positions
 
-def snfpsf(wave, psfparams, header, psftype):
-    """Create a 3-d PSF based on SNFactory-specific parameterization of
-    Gaussian + Moffat PSF parameters and ADR."""
+def snf_tied_params(alpha):
+    """SNFactory Gaussian + Moffat parameters (sigma, beta, eta) as a
+    function of the Moffat width alpha."""
+
+    # correlated parameters (coefficients determined externally)
+    sigma = 0.545 + 0.215 * alpha  # Gaussian parameter
+    beta  = 1.685 + 0.345 * alpha  # Moffat parameter
+    eta   = 1.040 + 0.0   * alpha  # gaussian ampl. / moffat ampl.
+
+    return sigma, beta, eta
+
+
+def snf_profile_params(wave, psfparams, header):
+    """Gaussian + Moffat parameters (sigma, alpha, beta, ellipticity, eta,
+    yctr, xctr) at each wavelength, from the SNFactory-specific
+    parameterization `psfparams` and ADR for the observation described
+    by `header`."""
 
     # Get Gaussian+Moffat parameters at each wavelength.
     relwave = wave / REFWAVE - 1.0
@@ -46,10 +62,7 @@ def snfpsf(wave, psfparams, header, psftype):
                    psfparams[2] * relwave +
                    psfparams[3] * relwave**2)
 
-    # correlated parameters (coefficients determined externally)
-    sigma = 0.545 + 0.215 * alpha  # Gaussian parameter
-    beta  = 1.685 + 0.345 * alpha  # Moffat parameter
-    eta   = 1.040 + 0.0   * alpha  # gaussian ampl. / moffat ampl.
+    sigma, beta, eta = snf_tied_params(alpha)
 
     # Atmospheric differential refraction (ADR): Because of ADR,
     # the center of the PSF will be different at each wavelength,
@@ -82,16 +95,66 @@ def snfpsf(wave, psfparams, header, psftype):
     # adr_refract[0, :] corresponds to x, adr_refract[1, :] => y
     xctr, yctr = adr_refract
 
+    return sigma, alpha, beta, ellipticity, eta, yctr, xctr
+
+
+def snfpsfs(wave, psfparams, headers, psftype, threads=None,
+            dtype=np.float64, templates=None, compress=None, truncate=None):
+    """Create 3-d PSFs for several epochs based on SNFactory-specific
+    parameterization of Gaussian + Moffat PSF parameters and ADR.
+
+    `psfparams` and `headers` are lists with one entry per epoch. The
+    PSFs of all epochs are evaluated, and Fourier transformed, in one
+    batch.
+
+    `threads` is the number of threads used in the PSF's FFTs and in
+    evaluating the analytic PSF (default given by `default_threads`),
+    `dtype` is the floating point type used in FFTs and model evaluation,
+    `templates` is an optional `PSFTemplates` (built on
+    `snf_tied_params`) from which 'gaussian-moffat' PSFs are
+    interpolated, `compress` is the relative error of compressed
+    PSF storage, if any (see `cubefit.psf.PSFBase`) and `truncate` is
+    the level, relative to the peak, below which the analytic PSF is not
+    evaluated, if any (see `cubefit.psffuncs.gaussian_moffat_psf`).
+    """
+
+    if psftype not in ('gaussian-moffat', 'tabular'):
+        raise ValueError("unknown psf type: " + repr(psftype))
+
+    # arrays of shape (nepochs, nw) for each of sigma, alpha, ...
+    params = [np.array(p) for p in
+              zip(*[snf_profile_params(wave, psfparams[i], headers[i])
+                    for i in range(len(psfparams))])]
+
+    if threads is None:
+        threads = default_threads(len(wave))
+
     if psftype == 'gaussian-moffat':
-        return GaussianMoffatPSF(sigma, alpha, beta, ellipticity, eta,
-                                 yctr, xctr, MODEL_SHAPE, subpix=3)
+        return GaussianMoffatPSF.batch(*params, shape=MODEL_SHAPE, subpix=3,
+                                       threads=threads, dtype=dtype,
+                                       templates=templates,
+                                       compress=compress, truncate=truncate)
 
-    elif psftype == 'tabular':
-        A = gaussian_moffat_psf(sigma, alpha, beta, ellipticity, eta,
-                                yctr, xctr, MODEL_SHAPE, subpix=3)
-        return TabularPSF(A)
     else:
-        raise ValueError("unknown psf type: " + repr(psftype))
+        A = gaussian_moffat_psf(*([p.ravel() for p in params] +
+                                  [MODEL_SHAPE]),
+                                subpix=3, threads=threads, truncate=truncate)
+        A = A.reshape(params[0].shape + MODEL_SHAPE)
+        return TabularPSF.batch(A, threads=threads, dtype=dtype,
+                                compress=compress)
+
+
+def snfpsf(wave, psfparams, header, psftype, threads=None, dtype=np.float64,
+           templates=None, compress=None, truncate=None):
+    """Create a 3-d PSF based on SNFactory-specific parameterization of
+    Gaussian + Moffat PSF parameters and ADR.
+
+    This is `snfpsfs` for a single epoch.
+    """
+
+    return snfpsfs(wave, [psfparams], [header], psftype, threads=threads,
+                   dtype=dtype, templates=templates, compress=compress,
+                   truncate=truncate)[0]
 
 
 def setup_logging(loglevel, logfname=None):
@@ -143,6 +206,56 @@ def cubefit(argv=None):
                         help="Type of PSF: 'gaussian-moffat' or 'tabular'. "
                         "Currently, tabular means generate a tabular PSF from "
                         "gaussian-moffat parameters.")
+    parser.add_argument("--threads", default=None, type=int,
+                        help="Number of threads to use in FFTs and PSF "
+                        "evaluation. Default is the number of CPUs.")
+    parser.add_argument("--epoch_threads", default=1, type=int,
+                        help="Number of threads over which epochs are "
+                        "divided in multi-epoch galaxy fits (each also "
+                        "uses --threads in FFTs). Default is 1.")
+    parser.add_argument("--processes", default=1, type=int,
+                        help="Number of worker processes for fitting the "
+                        "positions of non-master refs (each also uses "
+                        "--threads in FFTs). Default is 1.")
+    parser.add_argument("--float32", default=False, action="store_true",
+                        help="Use single precision in FFTs and model "
+                        "evaluation (chi^2 is still accumulated in double "
+                        "precision).")
+    parser.add_argument("--templates", default=False, action="store_true",
+                        help="Interpolate gaussian-moffat PSFs from a "
+                        "library of precomputed (pixel-integrated) "
+                        "profiles rather than evaluating them.")
+    parser.add_argument("--compress_psf", default=None, type=float,
+                        metavar="TOL",
+                        help="Store each epoch's PSF in compressed form "
+                        "(a few basis kernels), with relative error TOL "
+                        "(e.g., 1e-4). Reduces memory for many "
+                        "wavelengths, at some cost in speed.")
+    parser.add_argument("--truncate_psf", default=None, type=float,
+                        metavar="LEVEL",
+                        help="Only evaluate the analytic PSF where it is "
+                        "above LEVEL times its peak (e.g., 1e-5), "
+                        "renormalizing for the flux outside. Saves time "
+                        "on large model grids.")
+    parser.add_argument("--fourier_sn", default=False, action="store_true",
+                        help="In SN position fits, move the SN by shifting "
+                        "the tabulated PSF in Fourier space rather than "
+                        "re-evaluating the analytic PSF. Faster, but less "
+                        "accurate for narrow PSFs.")
+    parser.add_argument("--sn_fit", default="joint",
+                        choices=["joint", "block"],
+                        help="Method for fitting epoch and SN positions: "
+                        "'joint' (L-BFGS-B on all positions) or 'block' "
+                        "(Levenberg-Marquardt steps decomposed by epoch, "
+                        "with epochs evaluated in --epoch_threads). "
+                        "Default is joint.")
+    parser.add_argument("--planner", default="measure",
+                        choices=["estimate", "measure", "patient",
+                                 "exhaustive"],
+                        help="FFTW planner effort. Default is measure.")
+    parser.add_argument("--wisdomdir", default=None,
+                        help="If given, load FFTW wisdom from this "
+                        "directory and save new wisdom to it on exit.")
     args = parser.parse_args(argv)
 
     setup_logging(args.loglevel, logfname=args.logfile)
@@ -155,7 +268,16 @@ def cubefit(argv=None):
 
     logging.info("parameters: mu_wave={:.3g} mu_xy={:.3g} refitgal={}"
                  .format(args.mu_wave, args.mu_xy, args.refitgal))
-    logging.info("            psftype={}".format(args.psftype))
+    logging.info("            psftype={} threads={} epoch_threads={} "
+                 "planner={} float32={} templates={} sn_fit={}"
+                 .format(args.psftype, args.threads, args.epoch_threads,
+                         args.planner, args.float32, args.templates,
+                         args.sn_fit))
+
+    set_planner_effort(args.planner)
+    if args.wisdomdir is not None:
+        logging.info("loading FFTW wisdom from %s", args.wisdomdir)
+        load_wisdom(args.wisdomdir)
 
     logging.info("reading config file")
     with open(args.configfile) as f:
@@ -195,8 +317,17 @@ def cubefit(argv=None):
     # PSF for each observation
 
     logging.info("setting up PSF for all %d epochs", nt)
-    psfs = [snfpsf(wave, cfg["psf_params"][i], cubes[i].header, args.psftype)
-            for i in range(nt)]
+    dtype = np.float32 if args.float32 else np.float64
+    templates = None
+    if args.templates:
+        templates = PSFTemplates(
+            snf_tied_params,
+            threads=(default_threads(nw) if args.threads is None
+                     else args.threads))
+    psfs = snfpsfs(wave, cfg["psf_params"], [cube.header for cube in cubes],
+                   args.psftype, threads=args.threads, dtype=dtype,
+                   templates=templates, compress=args.compress_psf,
+                   truncate=args.truncate_psf)
 
     # -------------------------------------------------------------------------
     # Initialize all model parameters to be fit
@@ -294,8 +425,12 @@ def cubefit(argv=None):
     #
     # If there are less than 20 "significant" spaxels, we do not attempt to
     # fit the position, but simply leave it as is.
+    #
+    # The fits are independent, so they are done in a pool of processes.
 
     logging.info("fitting position of non-master refs %s", nonmaster_refs)
+    fitrefs = []
+    fitweights = []
     for i in nonmaster_refs:
         cube = cubes[i]
 
@@ -310,116 +445,60 @@ def cubefit(argv=None):
         if mask.sum() < 20:
             continue
 
-        weight = cube.weight * mask[None, :, :]
+        fitrefs.append(i)
+        fitweights.append(cube.weight * mask[None, :, :])
 
-        fctr, fsky = fit_position_sky(galaxy, cube.data, weight,
-                                      (yctr[i], xctr[i]), psfs[i],
-                                      (yctrbounds[i], xctrbounds[i]))
+    fctrs, fskys = fit_position_sky_pool(
+        galaxy, [cubes[i].data for i in fitrefs], fitweights,
+        [(yctr[i], xctr[i]) for i in fitrefs], [psfs[i] for i in fitrefs],
+        [(yctrbounds[i], xctrbounds[i]) for i in fitrefs],
+        processes=args.processes)
+    for i, fctr, fsky in zip(fitrefs, fctrs, fskys):
         yctr[i], xctr[i] = fctr
         skys[i, :] = fsky
 
     tsteps["fit positions of other refs"] = datetime.now()
 
-    # -------------------------------------------------------------------------
-    # Redo model fit, this time including all final refs.
-
-    datas = [cubes[i].data for i in refs]
-    weights = [cubes[i].weight for i in refs]
-    ctrs = [(yctr[i], xctr[i]) for i in refs]
-    psfs_refs = [psfs[i] for i in refs]
-    logging.info("fitting galaxy to all refs %s", refs)
-    galaxy, fskys = fit_galaxy_sky_multi(galaxy, datas, weights, ctrs,
-                                         psfs_refs, regpenalty, LBFGSB_FACTOR)
+    # Thread pool for evaluating epochs concurrently in the remaining
+    # fits. It is created only now so that the process pool above is not
+    # forked while its threads are running.
+    executor = None
+    if args.epoch_threads > 1:
+        executor = ThreadPool(args.epoch_threads)
 
-    # put fitted skys back in `skys`
-    for i,j in enumerate(refs):
-        skys[j, :] = fskys[i]
-
-    if args.diagdir:
-        fname = os.path.join(args.diagdir, 'step2.fits')
-        write_results(galaxy, skys, sn, snctr, yctr, xctr, yctr0, xctr0,
-                      yctrbounds, xctrbounds, cubes, psfs, modelwcs, fname)
+    try:
+        # ---------------------------------------------------------------------
+        # Redo model fit, this time including all final refs.
 
-    tsteps["fit galaxy to all refs"] = datetime.now()
+        datas = [cubes[i].data for i in refs]
+        weights = [cubes[i].weight for i in refs]
+        ctrs = [(yctr[i], xctr[i]) for i in refs]
+        psfs_refs = [psfs[i] for i in refs]
+        logging.info("fitting galaxy to all refs %s", refs)
+        galaxy, fskys = fit_galaxy_sky_multi(galaxy, datas, weights, ctrs,
+                                             psfs_refs, regpenalty,
+                                             LBFGSB_FACTOR, executor=executor)
 
-    # -------------------------------------------------------------------------
-    # Fit position of data and SN in non-references
-    #
-    # Now we think we have a good galaxy model. We fix this and fit
-    # the relative position of the remaining epochs (which presumably
-    # all have some SN light). We simultaneously fit the position of
-    # the SN itself.
-
-    logging.info("fitting position of all %d non-refs and SN position",
-                 len(nonrefs))
-    if len(nonrefs) > 0:
-        datas = [cubes[i].data for i in nonrefs]
-        weights = [cubes[i].weight for i in nonrefs]
-        psfs_nonrefs = [psfs[i] for i in nonrefs]
-        fyctr, fxctr, snctr, fskys, fsne = fit_position_sky_sn_multi(
-            galaxy, datas, weights, yctr[nonrefs], xctr[nonrefs],
-            snctr, psfs_nonrefs, LBFGSB_FACTOR, yctrbounds[nonrefs],
-            xctrbounds[nonrefs], snctrbounds)
-
-        # put fitted results back in parameter lists.
-        yctr[nonrefs] = fyctr
-        xctr[nonrefs] = fxctr
-        for i,j in enumerate(nonrefs):
+        # put fitted skys back in `skys`
+        for i,j in enumerate(refs):
             skys[j, :] = fskys[i]
-            sn[j, :] = fsne[i]
-
-    tsteps["fit positions of nonrefs & SN"] = datetime.now()
-
-    # -------------------------------------------------------------------------
-    # optional step(s)
-
-    if args.refitgal and len(nonrefs) > 0:
 
         if args.diagdir:
-            fname = os.path.join(args.diagdir, 'step3.fits')
+            fname = os.path.join(args.diagdir, 'step2.fits')
             write_results(galaxy, skys, sn, snctr, yctr, xctr, yctr0, xctr0,
                           yctrbounds, xctrbounds, cubes, psfs, modelwcs, fname)
 
-        # ---------------------------------------------------------------------
-        # Redo fit of galaxy, using ALL epochs, including ones with SN
-        # light.  We hold the SN "fixed" simply by subtracting it from the
-        # data and fitting the remainder.
-        #
-        # This is slightly dangerous: any errors in the original SN
-        # determination, whether due to an incorrect PSF or ADR model
-        # or errors in the galaxy model will result in residuals. The
-        # galaxy model will then try to compensate for these.
-        #
-        # We should look at the galaxy model at the position of the SN
-        # before and after this step to see if there is a bias towards
-        # the galaxy flux increasing.
-
-        logging.info("fitting galaxy using all %d epochs", nt)
-        datas = [cube.data for cube in cubes]
-        weights = [cube.weight for cube in cubes]
-        ctrs = [(yctr[i], xctr[i]) for i in range(nt)]
-
-        # subtract SN from non-ref cubes.
-        for i in nonrefs:
-            s = psfs[i].point_source(snctr, datas[i].shape[1:3], ctrs[i])
-            # do *not* use in-place operation (-=) here!
-            datas[i] = cubes[i].data - sn[i, :, None, None] * s
-
-        galaxy, fskys = fit_galaxy_sky_multi(galaxy, datas, weights, ctrs,
-                                             psfs, regpenalty, LBFGSB_FACTOR)
-        for i in range(nt):
-            skys[i, :] = fskys[i]  # put fitted skys back in skys
-
-        if args.diagdir:
-            fname = os.path.join(args.diagdir, 'step4.fits')
-            write_results(galaxy, skys, sn, snctr, yctr, xctr, yctr0, xctr0,
-                          yctrbounds, xctrbounds, cubes, psfs, modelwcs, fname)
+        tsteps["fit galaxy to all refs"] = datetime.now()
 
         # ---------------------------------------------------------------------
-        # Repeat step before last: fit position of data and SN in
-        # non-references
+        # Fit position of data and SN in non-references
+        #
+        # Now we think we have a good galaxy model. We fix this and fit
+        # the relative position of the remaining epochs (which presumably
+        # all have some SN light). We simultaneously fit the position of
+        # the SN itself.
 
-        logging.info("re-fitting position of all %d non-refs and SN position",
+        logging.info("fitting position of all %d non-refs and SN position",
                      len(nonrefs))
         if len(nonrefs) > 0:
             datas = [cubes[i].data for i in nonrefs]
@@ -428,15 +507,94 @@ def cubefit(argv=None):
             fyctr, fxctr, snctr, fskys, fsne = fit_position_sky_sn_multi(
                 galaxy, datas, weights, yctr[nonrefs], xctr[nonrefs],
                 snctr, psfs_nonrefs, LBFGSB_FACTOR, yctrbounds[nonrefs],
-                xctrbounds[nonrefs], snctrbounds)
+                xctrbounds[nonrefs], snctrbounds, fourier=args.fourier_sn,
+                method=args.sn_fit, executor=executor)
 
             # put fitted results back in parameter lists.
             yctr[nonrefs] = fyctr
             xctr[nonrefs] = fxctr
-            for i, j in enumerate(nonrefs):
+            for i,j in enumerate(nonrefs):
                 skys[j, :] = fskys[i]
                 sn[j, :] = fsne[i]
 
+        tsteps["fit positions of nonrefs & SN"] = datetime.now()
+
+        # ---------------------------------------------------------------------
+        # optional step(s)
+
+        if args.refitgal and len(nonrefs) > 0:
+
+            if args.diagdir:
+                fname = os.path.join(args.diagdir, 'step3.fits')
+                write_results(galaxy, skys, sn, snctr, yctr, xctr, yctr0,
+                              xctr0, yctrbounds, xctrbounds, cubes, psfs,
+                              modelwcs, fname)
+
+            # -----------------------------------------------------------------
+            # Redo fit of galaxy, using ALL epochs, including ones with SN
+            # light.  We hold the SN "fixed" simply by subtracting it from the
+            # data and fitting the remainder.
+            #
+            # This is slightly dangerous: any errors in the original SN
+            # determination, whether due to an incorrect PSF or ADR model
+            # or errors in the galaxy model will result in residuals. The
+            # galaxy model will then try to compensate for these.
+            #
+            # We should look at the galaxy model at the position of the SN
+            # before and after this step to see if there is a bias towards
+            # the galaxy flux increasing.
+
+            logging.info("fitting galaxy using all %d epochs", nt)
+            datas = [cube.data for cube in cubes]
+            weights = [cube.weight for cube in cubes]
+            ctrs = [(yctr[i], xctr[i]) for i in range(nt)]
+
+            # subtract SN from non-ref cubes.
+            for i in nonrefs:
+                s = psfs[i].point_source(snctr, datas[i].shape[1:3], ctrs[i])
+                # do *not* use in-place operation (-=) here!
+                datas[i] = cubes[i].data - sn[i, :, None, None] * s
+
+            galaxy, fskys = fit_galaxy_sky_multi(galaxy, datas, weights, ctrs,
+                                                 psfs, regpenalty,
+                                                 LBFGSB_FACTOR,
+                                                 executor=executor)
+            for i in range(nt):
+                skys[i, :] = fskys[i]  # put fitted skys back in skys
+
+            if args.diagdir:
+                fname = os.path.join(args.diagdir, 'step4.fits')
+                write_results(galaxy, skys, sn, snctr, yctr, xctr, yctr0,
+                              xctr0, yctrbounds, xctrbounds, cubes, psfs,
+                              modelwcs, fname)
+
+            # -----------------------------------------------------------------
+            # Repeat step before last: fit position of data and SN in
+            # non-references
+
+            logging.info("re-fitting position of all %d non-refs and SN "
+                         "position", len(nonrefs))
+            if len(nonrefs) > 0:
+                datas = [cubes[i].data for i in nonrefs]
+                weights = [cubes[i].weight for i in nonrefs]
+                psfs_nonrefs = [psfs[i] for i in nonrefs]
+                fyctr, fxctr, snctr, fskys, fsne = fit_position_sky_sn_multi(
+                    galaxy, datas, weights, yctr[nonrefs], xctr[nonrefs],
+                    snctr, psfs_nonrefs, LBFGSB_FACTOR, yctrbounds[nonrefs],
+                    xctrbounds[nonrefs], snctrbounds, fourier=args.fourier_sn,
+                    method=args.sn_fit, executor=executor)
+
+                # put fitted results back in parameter lists.
+                yctr[nonrefs] = fyctr
+                xctr[nonrefs] = fxctr
+                for i, j in enumerate(nonrefs):
+                    skys[j, :] = fskys[i]
+                    sn[j, :] = fsne[i]
+    finally:
+        if executor is not None:
+            executor.close()
+            executor.join()
+
     # -------------------------------------------------------------------------
     # Write results
 
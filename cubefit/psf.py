@@ -1,19 +1,338 @@
 from __future__ import division
 
+import atexit
+from contextlib import contextmanager
+import logging
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+
 import numpy as np
-from numpy.fft import fft2, ifft2
 import pyfftw
+import pyfftw.interfaces.numpy_fft
+
+from .utils import (fft_shift_phasor, fft_shift_phasor_2d, yxoffset,
+                    idft_matrix, dft_matrix)
+from .psffuncs import gaussian_moffat_psf, template_psf
+
+__all__ = ["TabularPSF", "GaussianMoffatPSF", "PSFTemplates",
+           "LowRankSpectrum", "set_planner_effort", "load_wisdom",
+           "save_wisdom"]
+
+PLANNER_EFFORTS = ("FFTW_ESTIMATE", "FFTW_MEASURE", "FFTW_PATIENT",
+                   "FFTW_EXHAUSTIVE")
+
+# FFTW planning settings used by all PSFs. See `set_planner_effort` and
+# `load_wisdom`.
+_planner_effort = "FFTW_MEASURE"
+WISDOM_FNAME = "wisdom.pkl"
+_wisdom_dir = None
+_wisdom_keys = set()  # keys of plans made in this process
+_wisdom_saved_keys = set()  # keys of plans in the wisdom file
+
+
+def set_planner_effort(effort):
+    """Set the FFTW planner effort used for subsequently created PSFs.
+
+    Parameters
+    ----------
+    effort : str
+        One of 'estimate', 'measure' (the default), 'patient' or
+        'exhaustive' (case insensitive, with or without the 'FFTW_'
+        prefix). Higher effort takes longer to plan, but may give
+        faster transforms. Use with `load_wisdom` so that the planning
+        cost is paid only once.
+    """
+    global _planner_effort
+
+    effort = effort.upper()
+    if not effort.startswith("FFTW_"):
+        effort = "FFTW_" + effort
+    if effort not in PLANNER_EFFORTS:
+        raise ValueError("unknown planner effort: " + repr(effort))
+    _planner_effort = effort
+
+
+def _read_wisdom(fname):
+    """Import the wisdom in file `fname` and return the plan keys it
+    covers (empty if it cannot be read)."""
+    try:
+        with open(fname, "rb") as f:
+            keys, wisdom = pickle.load(f)
+        pyfftw.import_wisdom(wisdom)
+    except Exception as e:
+        logging.warning("could not load FFTW wisdom from %s: %s", fname, e)
+        return set()
+    return set(keys)
+
+
+def load_wisdom(dirname):
+    """Load FFTW wisdom from a cache directory and save to it on exit.
+
+    Wisdom is stored in a single file, WISDOM_FNAME, in `dirname`,
+    which is loaded now. The file also records the plan types (array
+    shape, dtype, number of threads and planner effort) that it covers.
+    At exit (or when `save_wisdom` is called), if plans of other types
+    were made in this process, the file is replaced by the merged
+    wisdom of this process and the file. The directory is created if
+    necessary.
+    """
+    global _wisdom_dir
+
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    fname = os.path.join(dirname, WISDOM_FNAME)
+    if os.path.exists(fname):
+        _wisdom_saved_keys.update(_read_wisdom(fname))
+
+    if _wisdom_dir is None:
+        atexit.register(save_wisdom)
+    _wisdom_dir = dirname
+
+
+def save_wisdom():
+    """Save FFTW wisdom to the directory given in `load_wisdom` (if any),
+    if plan types not yet in the wisdom file were made in this process."""
+
+    if _wisdom_dir is None or _wisdom_keys <= _wisdom_saved_keys:
+        return
+
+    # Merge in wisdom saved by other processes since it was loaded.
+    fname = os.path.join(_wisdom_dir, WISDOM_FNAME)
+    keys = _wisdom_keys | _wisdom_saved_keys
+    if os.path.exists(fname):
+        keys |= _read_wisdom(fname)
+    wisdom = pyfftw.export_wisdom()
+
+    # Write to a temporary file and rename, so that concurrent
+    # processes never see a partially written file.
+    fd, tmpfname = tempfile.mkstemp(dir=_wisdom_dir)
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump((sorted(keys), wisdom), f, protocol=2)
+    os.rename(tmpfname, fname)
+    _wisdom_saved_keys.update(keys)
+
+
+class FFTWorkspace(object):
+    """Scratch arrays and FFTW plans for batched 2-d real FFTs.
+
+    Attributes `fftin` (real, shape `shape`) and `fftout` (its half
+    spectrum, shape ``shape[:-1] + (shape[-1]//2 + 1,)``) are the
+    input and output of the forward transform `fft`, and the reverse
+    for the backward transform `ifft` (which may overwrite `fftout`).
+    The transforms are over the last two axes.
+    """
+
+    def __init__(self, shape, dtype, threads, effort):
+        dtype = np.dtype(dtype)
+        cdtype = np.result_type(dtype, np.complex64)
+        fftshape = tuple(shape[:-1]) + (shape[-1] // 2 + 1,)
+
+        self.fftin = pyfftw.empty_aligned(shape, dtype=dtype)
+        self.fftout = pyfftw.empty_aligned(fftshape, dtype=cdtype)
+        flags = (effort,)
+        self.fft = pyfftw.FFTW(self.fftin, self.fftout, axes=(-2, -1),
+                               threads=threads, flags=flags)
+        self.ifft = pyfftw.FFTW(self.fftout, self.fftin, axes=(-2, -1),
+                                threads=threads, flags=flags,
+                                direction='FFTW_BACKWARD')
+        _wisdom_keys.add((tuple(shape), dtype.name, threads, effort))
+
+
+class WorkspacePool(object):
+    """Pool of FFT workspaces shared between PSFs.
+
+    Workspaces are keyed by (shape, dtype, threads, planner effort), so
+    that all PSFs with the same model shape and settings draw from the
+    same free list. A workspace is created only when a PSF asks for one
+    and none is free, so the pool grows to the peak number of
+    concurrent users (one, in single-threaded use) rather than to the
+    number of PSFs.
+    """
+
+    def __init__(self):
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take a free workspace for `key`, creating one if necessary."""
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+        return FFTWorkspace(*key)
+
+    def release(self, key, ws):
+        """Return a workspace acquired with `acquire` to the pool."""
+        with self._lock:
+            self._free.setdefault(key, []).append(ws)
+
+    @contextmanager
+    def borrow(self, key):
+        """Context manager acquiring and releasing a workspace."""
+        ws = self.acquire(key)
+        try:
+            yield ws
+        finally:
+            self.release(key, ws)
+
+    def size(self, key=None):
+        """Number of free workspaces (for a given key, or in total)."""
+        with self._lock:
+            if key is not None:
+                return len(self._free.get(key, []))
+            return sum(len(v) for v in self._free.values())
+
+    def clear(self):
+        """Drop all free workspaces, releasing their memory."""
+        with self._lock:
+            self._free.clear()
+
+
+# Workspaces for all PSFs in this process.
+_workspace_pool = WorkspacePool()
+
+
+def default_threads(nw):
+    """Default number of threads for FFTs over `nw` wavelength slices.
+
+    This is the number of available CPUs, but no more than `nw` (each
+    transform is a batch of `nw` independent 2-d FFTs, so extra threads
+    would have nothing to do).
+    """
+    try:
+        ncpu = multiprocessing.cpu_count()
+    except NotImplementedError:
+        ncpu = 1
+    return max(1, min(ncpu, nw))
+
+
+def _psf_fftconv(A, threads):
+    """Half spectrum (over the last two axes) of the PSF `A`, shifted to
+    be centered on the lower left pixel. See `PSFBase`."""
+
+    ny, nx = A.shape[-2:]
+    shift = -(ny - 1) / 2., -(nx - 1) / 2.
+    fshift = fft_shift_phasor_2d((ny, nx), shift, half=True)
+    return pyfftw.interfaces.numpy_fft.rfft2(
+        A, threads=threads, planner_effort='FFTW_ESTIMATE') * fshift
+
+
+class LowRankSpectrum(object):
+    """Low-rank approximation of PSF spectra varying with wavelength.
+
+    The spectrum at each wavelength is stored as a phasor (a shift, in
+    real space, by `shifts`) times a linear combination of `rank` basis
+    spectra common to all wavelengths. Because the shape of the PSF varies
+    slowly with wavelength once its position is factored out, a few basis
+    spectra suffice.
+
+    Parameters
+    ----------
+    fspec : ndarray (3-d)
+        Half spectra, shape (nw, ny, nx//2 + 1).
+    nx : int
+        Length of the last axis in real space.
+    shifts : ndarray (2-d)
+        Shape (nw, 2). Approximate (y, x) position of the PSF at each
+        wavelength, relative to its position in `fspec`. Any value can be
+        given; good estimates reduce the rank needed.
+    tol : float
+        The rank is the smallest for which the root-mean-square error of
+        the PSF (in real space) at each wavelength is at most `tol` times
+        its root-mean-square value.
+    dtype : numpy dtype, optional
+        Complex type of stored and reconstructed arrays.
+
+    Attributes
+    ----------
+    rank : int
+    error : float
+        Maximum relative error over wavelengths (at most `tol`).
+    nbytes : int
+        Memory used by the approximation.
+    """
+
+    def __init__(self, fspec, nx, shifts, tol, dtype=np.complex128):
+        nw, ny, nh = fspec.shape
+        self.shape = fspec.shape
+        self.nx = nx
+        self.shifts = np.array(shifts, dtype=np.float64)
 
-from .utils import fft_shift_phasor_2d, yxoffset
-from .psffuncs import gaussian_moffat_psf
+        # Parseval weights of the half spectrum (elements other than zero
+        # and Nyquist frequency stand for two elements of the full one).
+        w = 2. * np.ones(nh)
+        w[0] = 1.
+        if nx % 2 == 0:
+            w[-1] = 1.
+        sqrtw = np.sqrt(w)
 
-__all__ = ["TabularPSF", "GaussianMoffatPSF"]
+        # remove shifts, weight and reshape to (nw, ny * nh).
+        py, px = self._phasors()
+        g = fspec * np.conj(py)[:, :, None] * (np.conj(px) * sqrtw)[:, None, :]
+        g = g.reshape(nw, ny * nh)
+
+        u, sv, vh = np.linalg.svd(g, full_matrices=False)
+
+        # Squared error of each row at each rank, from the squared norms
+        # of its components.
+        c2 = np.abs(u * sv)**2
+        err2 = np.sum(c2, axis=1)[:, None] - np.cumsum(c2, axis=1)
+        norm2 = np.sum(np.abs(g)**2, axis=1)
+        relerr = np.sqrt(np.max(np.maximum(err2, 0.) /
+                                np.maximum(norm2[:, None], 1.e-300), axis=0))
+        rank = int(np.argmax(relerr <= tol)) + 1
+        if relerr[rank - 1] > tol:  # (full rank needed)
+            rank = len(relerr)
+
+        self.rank = rank
+        self.error = relerr[rank - 1]
+        self.coeffs = np.asarray(u[:, :rank] * sv[:rank], dtype=dtype)
+        self.basis = np.asarray((vh[:rank].reshape(rank, ny, nh) / sqrtw),
+                                dtype=dtype)
+
+    @property
+    def nbytes(self):
+        return self.coeffs.nbytes + self.basis.nbytes + self.shifts.nbytes
+
+    def _phasors(self):
+        """Phasors (unit magnitude) for `shifts` along y and x."""
+        ny = self.shape[1]
+        py = np.exp(-2j * np.pi * np.fft.fftfreq(ny) * self.shifts[:, 0:1])
+        px = np.exp(-2j * np.pi * np.fft.rfftfreq(self.nx) *
+                    self.shifts[:, 1:2])
+        return py, px
+
+    def reconstruct(self):
+        """Return the (approximate) spectra, shape (nw, ny, nx//2 + 1)."""
+        nw, ny, nh = self.shape
+        fspec = np.dot(self.coeffs, self.basis.reshape(self.rank, ny * nh))
+        fspec = fspec.reshape(self.shape)
+        py, px = self._phasors()
+        fspec *= py.astype(fspec.dtype)[:, :, None]
+        fspec *= px.astype(fspec.dtype)[:, None, :]
+        return fspec
 
 
 class PSFBase(object):
-    """Base class for 3-d PSFs."""
+    """Base class for 3-d PSFs.
 
-    def __init__(self, A):
+    PSF methods are reentrant: each call borrows its own FFT workspace
+    (see `WorkspacePool`), so one PSF may be evaluated from several
+    threads at once. The exception is `cache_galaxy`, which changes
+    what later `evaluate_galaxy` calls compute.
+
+    PSFs can be pickled (e.g., to send them to worker processes). Only
+    the PSF parameters and Fourier-space kernel are stored; the FFT
+    plans are created again in the receiving process on first use, and
+    the galaxy cache is cleared.
+    """
+
+    def __init__(self, A, threads=None, sampling='auto', dtype=np.float64,
+                 fftconv=None, compress=None):
         """Set up arrays and FFTs for convolution.
 
         Parameters
@@ -21,10 +340,59 @@ class PSFBase(object):
         A : ndarray (3-d)
             PSF, assumed to be centered in the array at the
             "reference wavelength."
+        threads : int, optional
+            Number of threads used in FFTs. Default is given by
+            `default_threads`.
+        sampling : {'auto', 'fft', 'dft'}, optional
+            How the model is sampled onto the (smaller) data grid after
+            shifting in Fourier space. 'fft' does a full inverse FFT and
+            keeps the needed corner. 'dft' evaluates only the needed output
+            pixels with a partial inverse DFT, done as two small matrix
+            products per wavelength. 'auto' (default) chooses whichever is
+            expected to be cheaper for the requested data shape.
+        dtype : numpy dtype, optional
+            Floating point type used in FFTs and model evaluation:
+            float64 (default) or float32. In single precision, the
+            corresponding complex type is complex64, halving memory and
+            memory bandwidth. The kernel `A` itself is transformed in
+            double precision before conversion.
+        fftconv : ndarray (3-d), optional
+            The (double precision) transform of `A` that would otherwise
+            be computed here, if already available (for example, when
+            constructing PSFs in a batch; see `TabularPSF.batch`).
+        compress : float, optional
+            If given, store `fftconv` as a `LowRankSpectrum` with this
+            relative error (the root-mean-square error of the PSF at each
+            wavelength relative to its root-mean-square value), and
+            reconstruct it whenever it is needed. This uses much less
+            memory for many wavelengths, at some cost in speed.
         """
 
+        if sampling not in ('auto', 'fft', 'dft'):
+            raise ValueError("unknown sampling: " + repr(sampling))
+        self.sampling = sampling
+
+        self.dtype = np.dtype(dtype)
+        if self.dtype == np.float64:
+            self.cdtype = np.dtype(np.complex128)
+        elif self.dtype == np.float32:
+            self.cdtype = np.dtype(np.complex64)
+        else:
+            raise ValueError("dtype must be float32 or float64")
+
         self.nw, self.ny, self.nx = A.shape
 
+        if threads is None:
+            threads = default_threads(self.nw)
+        self.threads = threads
+
+        # All transforms are real-to-complex: because the PSF and the
+        # galaxy model are real, their Fourier transforms are Hermitian
+        # and we only need to store and operate on the non-negative
+        # frequencies of the last axis. Arrays in Fourier space therefore
+        # have shape (nw, ny, nx//2 + 1).
+        self.fftshape = (self.nw, self.ny, self.nx // 2 + 1)
+
         # The attribute `fftconv` stores the Fourier-space array
         # necessary to convolve another array by the PSF. This is done
         # by mulitiplying the input array by `fftconv` in fourier
@@ -38,149 +406,597 @@ class PSFBase(object):
         # creating the PSF centered at the lower left pixel to begin
         # with, due to wrap-around.
         #
-        #`ifft2(fftconv).real` would be the PSF in
+        #`irfft2(fftconv)` would be the PSF in
         # real space, shifted to be centered on the lower-left pixel.
-        shift = -(self.ny - 1) / 2., -(self.nx - 1) / 2.
-        fshift = fft_shift_phasor_2d((self.ny, self.nx), shift)
-        fftconv = fft2(A) * fshift
-
-        # align on SIMD boundary.
-        self.fftconv = pyfftw.n_byte_align(fftconv, pyfftw.simd_alignment,
-                                           dtype=np.complex128)
-
-        # set up input and output arrays for FFTs.
-        self.fftin = pyfftw.n_byte_align_empty(A.shape,
-                                               pyfftw.simd_alignment,
-                                               dtype=np.complex128)
-        self.fftout = pyfftw.n_byte_align_empty(A.shape,
-                                                pyfftw.simd_alignment,
-                                                dtype=np.complex128)
-
-        # Set up forward and backward FFTs.
-        self.fft = pyfftw.FFTW(self.fftin, self.fftout, axes=(1, 2),
-                               threads=1)
-        self.ifft = pyfftw.FFTW(self.fftout, self.fftin, axes=(1, 2),
-                                threads=1, direction='FFTW_BACKWARD')
+        if fftconv is None:
+            fftconv = _psf_fftconv(A, threads)
+        elif fftconv.shape != self.fftshape:
+            raise ValueError("fftconv shape does not match A")
+
+        if compress is None:
+            # align on SIMD boundary.
+            self._fftconv = pyfftw.byte_align(
+                np.asarray(fftconv, dtype=self.cdtype))
+            self._fftconv_lr = None
+        else:
+            # Factor out the position of the PSF at each wavelength (its
+            # centroid relative to the array center).
+            y = np.arange(self.ny) - (self.ny - 1) / 2.
+            x = np.arange(self.nx) - (self.nx - 1) / 2.
+            total = A.sum(axis=(1, 2))
+            shifts = np.column_stack((np.dot(A.sum(axis=2), y) / total,
+                                      np.dot(A.sum(axis=1), x) / total))
+            self._fftconv = None
+            self._fftconv_lr = LowRankSpectrum(fftconv, self.nx, shifts,
+                                               compress, dtype=self.cdtype)
+
+        # Scratch arrays and FFT plans are not owned by the PSF, but
+        # borrowed from a pool shared with all other PSFs of the same
+        # shape for the duration of each call (see `_workspace`). We
+        # borrow one now so that planning is done up front.
+        self._wskey = (A.shape, self.dtype.name, threads, _planner_effort)
+        with self._workspace():
+            pass
 
         self.fftnorm = 1. / (self.ny * self.nx) 
 
+        # See `cache_galaxy`.
+        self._galcache = None
+
+        # DFT matrices for sampling, keyed by data shape. See `_use_dft`.
+        self._dftcache = {}
+
+    def __getstate__(self):
+        """State for pickling, without caches (which are rebuilt as
+        needed)."""
+        state = self.__dict__.copy()
+        state['_galcache'] = None
+        state['_dftcache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # (alignment is not preserved by pickling)
+        if self._fftconv is not None:
+            self._fftconv = pyfftw.byte_align(self._fftconv)
+
+    @property
+    def fftconv(self):
+        """Fourier-space array that convolves an array by the PSF (see
+        `__init__`), shape (nw, ny, nx//2 + 1). If compressed, this is
+        reconstructed on each access."""
+        if self._fftconv_lr is not None:
+            return self._fftconv_lr.reconstruct()
+        return self._fftconv
+
+    def _workspace(self):
+        """Context manager borrowing an `FFTWorkspace` from the pool.
+
+        The workspace has real array `fftin`, half-spectrum array
+        `fftout`, forward (real-to-complex) FFT `fft` from `fftin` to
+        `fftout` and backward FFT `ifft` from `fftout` to `fftin`.
+        Note that the backward transform may overwrite its input.
+        """
+        return _workspace_pool.borrow(self._wskey)
+
+    def fft_galaxy(self, galmodel):
+        """Fourier transform (half spectrum) of the galaxy model.
+
+        The result can be passed to `evaluate_galaxy_fft` of any PSF
+        with the same model shape, so that a galaxy shared by several
+        epochs need only be transformed once.
+        """
+        with self._workspace() as ws:
+            np.copyto(ws.fftin, galmodel)
+            ws.fft.execute()  # populates ws.fftout
+            return np.copy(ws.fftout)
+
+    def ifft_galaxy(self, fftgal):
+        """Inverse of `fft_galaxy` (`fftgal` is not modified)."""
+        with self._workspace() as ws:
+            np.multiply(fftgal, self.fftnorm, out=ws.fftout)
+            ws.ifft.execute()  # populates ws.fftin
+            return np.copy(ws.fftin)
+
+    def cache_galaxy(self, galmodel):
+        """Cache the convolved Fourier-space galaxy model.
+
+        Until `clear_galaxy_cache` is called, `evaluate_galaxy` calls
+        with this same array (checked by identity, not by value) skip
+        the forward transform and convolution, leaving only the shift
+        and the inverse transform(s). This is meant for fits where the
+        galaxy model is held fixed, such as position fits. `galmodel`
+        must not be modified in place while cached.
+        """
+        fftgalconv = self.fft_galaxy(galmodel)
+        fftgalconv *= self.fftconv
+        self._galcache = (galmodel, fftgalconv)
+
+    def clear_galaxy_cache(self):
+        """Clear the galaxy model cached by `cache_galaxy`."""
+        self._galcache = None
+
     def evaluate_galaxy(self, galmodel, shape, ctr, grad=False):
         """convolve, shift and sample the galaxy model"""
 
+        galcache = self._galcache  # (read once; may be reset by others)
+        with self._workspace() as ws:
+            if galcache is not None and galmodel is galcache[0]:
+                return self._evaluate_convolved(ws, galcache[1], shape, ctr,
+                                                grad)
+
+            np.copyto(ws.fftin, galmodel)
+            ws.fft.execute()  # populates ws.fftout
+            return self._evaluate_fft(ws, ws.fftout, shape, ctr, grad)
+
+    def evaluate_galaxy_fft(self, fftgal, shape, ctr, grad=False):
+        """Same as `evaluate_galaxy`, but taking the galaxy model already
+        Fourier transformed by `fft_galaxy`."""
+
+        with self._workspace() as ws:
+            return self._evaluate_fft(ws, fftgal, shape, ctr, grad)
+
+    def _evaluate_fft(self, ws, fftgal, shape, ctr, grad):
+        """`evaluate_galaxy_fft` using workspace `ws`. `fftgal` may be
+        `ws.fftout`."""
+
+        # calculate `rfft(galmodel) * fftconv`. If we need the gradient,
+        # this is used repeatedly, so put it in a separate array.
+        if grad:
+            fftgalconv = fftgal * self.fftconv
+        else:
+            fftgalconv = np.multiply(fftgal, self.fftconv, out=ws.fftout)
+
+        return self._evaluate_convolved(ws, fftgalconv, shape, ctr, grad)
+
+    def _evaluate_convolved(self, ws, fftgalconv, shape, ctr, grad):
+        """Shift and sample the convolved Fourier-space galaxy model.
+
+        `fftgalconv` may be `ws.fftout` only if `grad` is False."""
+
         # shift necessary to put model onto data coordinates
         offset = yxoffset((self.ny, self.nx), shape, ctr)
-        fshift = fft_shift_phasor_2d((self.ny, self.nx),
-                                     (-offset[0], -offset[1]), grad=grad)
+        res = self._sample(ws, fftgalconv, shape, (-offset[0], -offset[1]),
+                           grad=grad)
         if grad:
-            fshift, fshiftgrad = fshift
-            fshiftgrad *= -1.  # make derivatives w.r.t. `ctr`.
+            gal, galgrad = res
+            galgrad *= -1.  # make derivatives w.r.t. `ctr`.
+            return gal, galgrad
+
+        else:
+            return res
+
+    def _use_dft(self, shape):
+        """Whether to sample onto a grid of the given shape using a
+        partial DFT rather than a full inverse FFT."""
+
+        if shape[0] > self.ny or shape[1] > self.nx:
+            return False
+        if self.sampling != 'auto':
+            return self.sampling == 'dft'
+
+        # Rough cost of each method per wavelength: complex multiply-adds
+        # in the two matrix products versus N log2 N for the FFT. In
+        # benchmarks (see benchmarks/bench_psf.py), the matrix products
+        # become faster about where these are equal. For the typical
+        # 15 x 15 data and 32 x 32 model, the FFT is (barely) chosen.
+        nh = self.nx // 2 + 1
+        dftcost = shape[0] * nh * (self.ny + shape[1])
+        fftcost = self.ny * self.nx * np.log2(self.ny * self.nx)
+        return dftcost < fftcost
+
+    def _dft_matrices(self, shape):
+        """Partial inverse and forward DFT matrices for a given data shape.
 
-        # calculate `fft(galmodel) * fftconv`
-        np.copyto(self.fftin, galmodel)  # copy input array to complex array
-        self.fft.execute()  # populates self.fftout
-        self.fftout *= self.fftconv
+        Returns (iy, ix, fy, fx) where the inverse transform of a half
+        spectrum `z`, sampled on `shape`, is ``real(iy @ z @ ix)``
+        and the forward transform of `x` with shape `shape` is
+        ``fy @ x @ fx``.
+        """
+        key = tuple(shape)
+        mats = self._dftcache.get(key)
+        if mats is None:
+            mats = (idft_matrix(self.ny, shape[0]),
+                    idft_matrix(self.nx, shape[1], half=True).T,
+                    dft_matrix(self.ny, shape[0]),
+                    dft_matrix(self.nx, shape[1], half=True).T)
+            mats = tuple(np.array(a, dtype=self.cdtype) for a in mats)
+
+            # (if another thread got here first, use its matrices)
+            mats = self._dftcache.setdefault(key, mats)
+        return mats
+
+    def _phasor_2d(self, shift, grad=False):
+        """Half-spectrum shift phasor (see `fft_shift_phasor_2d`) in the
+        working complex dtype."""
+        res = fft_shift_phasor_2d((self.ny, self.nx), shift, grad=grad,
+                                  half=True)
         if grad:
-            fftgal = np.copy(self.fftout)  # cache result for use in gradient.
+            return (np.asarray(res[0], dtype=self.cdtype),
+                    np.asarray(res[1], dtype=self.cdtype))
+        return np.asarray(res, dtype=self.cdtype)
 
-        self.fftout *= fshift
-        self.ifft.execute() # populates self.fftin
-        self.fftin *= self.fftnorm
-        gal = np.copy(self.fftin.real[:, 0:shape[0], 0:shape[1]])
+    def _phasors(self, shift, grad=False):
+        """Separable y and x (half-spectrum) shift phasors (see
+        `fft_shift_phasor`) in the working complex dtype. If `grad` is
+        True, each is a (phasor, derivative) pair."""
+        yres = fft_shift_phasor(self.ny, shift[0], grad=grad)
+        xres = fft_shift_phasor(self.nx, shift[1], grad=grad, half=True)
+        if grad:
+            return (tuple(np.asarray(a, dtype=self.cdtype) for a in yres),
+                    tuple(np.asarray(a, dtype=self.cdtype) for a in xres))
+        return (np.asarray(yres, dtype=self.cdtype),
+                np.asarray(xres, dtype=self.cdtype))
+
+    def _sample(self, ws, fspec, shape, shift, grad=False):
+        """Shift a Fourier-space array and sample its inverse transform.
+
+        Returns the lower left `shape` corner of
+        ``irfft2(fspec * fshift)``, where `fshift` shifts by `shift`.
+        If `grad` is True, also return the derivatives with respect to
+        `shift` (shape ``(2, nw, shape[0], shape[1])``). The workspace
+        `ws` is used for the inverse FFTs; `fspec` may be `ws.fftout`
+        only if `grad` is False.
+        """
 
+        if self._use_dft(shape):
+            return self._sample_dft(fspec, shape, shift, grad)
+
+        fshift = self._phasor_2d(shift, grad=grad)
+
+        if not grad:
+            np.multiply(fspec, self.fftnorm * fshift, out=ws.fftout)
+            ws.ifft.execute() # populates ws.fftin
+            return np.copy(ws.fftin[:, 0:shape[0], 0:shape[1]])
+
+        # Value and the two shift derivatives: stack the (normalized)
+        # phasors and fill a single output array, one transform at a
+        # time. Each transform is already batched over wavelength;
+        # batching all three into one (3, nw, ny, nx) plan was found to
+        # be slower (see benchmarks/bench_psf.py).
+        fshift, fshiftgrad = fshift
+        fshifts = np.empty((3,) + fshift.shape, dtype=self.cdtype)
+        fshifts[0] = fshift
+        fshifts[1:3] = fshiftgrad
+        fshifts *= self.fftnorm
+
+        res = np.empty((3, self.nw, shape[0], shape[1]), dtype=self.dtype)
+        for i in range(3):
+            np.multiply(fspec, fshifts[i], out=ws.fftout)
+            ws.ifft.execute() # populates ws.fftin
+            res[i] = ws.fftin[:, 0:shape[0], 0:shape[1]]
+        return res[0], res[1:3]
+
+    def _sample_dft(self, fspec, shape, shift, grad):
+        """Same as `_sample`, using partial DFTs.
+
+        The shift phasor is separable, so rather than multiplying it into
+        the full spectrum, it is folded into the (small) DFT matrices.
+        """
+
+        nh = self.nx // 2 + 1
+        outshape = (self.nw, shape[0], shape[1])
+
+        iy, ix, _, _ = self._dft_matrices(shape)
+        yphasor, xphasor = self._phasors(shift, grad=grad)
         if grad:
-            galgrad = np.empty((2,) + gal.shape, dtype=np.float64)
-            for i in (0, 1):
-                np.copyto(self.fftout, fftgal)
-                self.fftout *= fshiftgrad[i]
-                self.ifft.execute() # populates self.fftin
-                self.fftin *= self.fftnorm
-                galgrad[i] = self.fftin.real[:, 0:shape[0], 0:shape[1]]
-            return gal, galgrad
+            yphasor, dyphasor = yphasor
+            xphasor, dxphasor = xphasor
+
+        # inverse transform in y, then in x.
+        tmp = np.matmul(iy * yphasor, fspec).reshape(-1, nh)
+        ixshift = ix * xphasor[:, None]
+        out = np.dot(tmp, ixshift).real.reshape(outshape)
+
+        if grad:
+            outgrad = np.empty((2,) + outshape, dtype=self.dtype)
+            tmpdy = np.matmul(iy * dyphasor, fspec).reshape(-1, nh)
+            outgrad[0] = np.dot(tmpdy, ixshift).real.reshape(outshape)
+            outgrad[1] = np.dot(tmp, ix * dxphasor[:, None]).real.reshape(
+                outshape)
+            return out, outgrad
+
+        else:
+            return out
+
+    def _gradient_fft(self, ws, x, shape, ctr, norm):
+        """Populate ws.fftout with the Fourier-space adjoint of
+        `evaluate_galaxy` applied to `x`, multiplied by `norm`."""
+
+        # shift necessary to put model onto data coordinates. The adjoint
+        # uses the conjugate phasor; we fold the normalization into it
+        # as well.
+        offset = yxoffset((self.ny, self.nx), shape, ctr)
+
+        # calculate `rfft(x) * conj(fshift) * norm`
+        if self._use_dft(x.shape[1:3]):
+            # Partial forward DFT of x (which is zero outside of
+            # `x.shape`), with the phasor folded into the DFT matrices.
+            nh = self.nx // 2 + 1
+            _, _, fy, fx = self._dft_matrices(x.shape[1:3])
+            yphasor, xphasor = self._phasors((-offset[0], -offset[1]))
+            x = np.asarray(x, dtype=self.dtype)
+            tmp = np.matmul(fy * np.conj(yphasor)[:, None], x)
+            np.dot(tmp.reshape(-1, x.shape[2]),
+                   fx * (norm * np.conj(xphasor)),
+                   out=ws.fftout.reshape(-1, nh))
 
         else:
-            return gal
+            fshift = self._phasor_2d((-offset[0], -offset[1]))
+
+            # zero-pad x to model size
+            ws.fftin.fill(0.)
+            ws.fftin[:, :x.shape[1], :x.shape[2]] = x
+            ws.fft.execute()  # populates ws.fftout
+            ws.fftout *= np.conj(fshift) * norm
+
+        # multiply by `conj(fftconv)`. The in-place conjugations avoid
+        # allocating a conjugated copy of `fftconv`.
+        np.conjugate(ws.fftout, out=ws.fftout)
+        ws.fftout *= self.fftconv
+        np.conjugate(ws.fftout, out=ws.fftout)
 
     def gradient_helper(self, x, shape, ctr):
-        """Not sure exactly what this does yet.
+        """Apply the adjoint of `evaluate_galaxy` to `x`.
+
+        This is the transpose of the sample-shift-convolve operation:
+        `x` is placed in the lower left corner of a model-sized array and
+        convolved with the conjugate of the (shifted) PSF. It is used to
+        propagate the gradient of chi^2 with respect to the data-space
+        model back to the galaxy model.
 
         Parameters
         ----------
-        i_t : int
-            Epoch index.
         x : np.ndarray (3-d)
             Same shape as *data* for single epoch (nw, ny, nx).
-        xcoords : np.ndarray (1-d)
-        ycoords : np.ndarray (1-d)
+        shape : tuple
+            Data shape (ny, nx).
+        ctr : tuple
+            Position of data in model coordinates.
 
         Returns
         -------
-        x : np.ndarray (3-d)
-            Shape is (nw, len(ycoords), len(xcoords)).
+        out : np.ndarray (3-d)
+            Shape is (nw, self.ny, self.nx), same as galaxy model.
         """
 
+        with self._workspace() as ws:
+            self._gradient_fft(ws, x, shape, ctr, self.fftnorm)
+            ws.ifft.execute()  # populates ws.fftin
+            return np.copy(ws.fftin)
+
+    def gradient_helper_fft(self, x, shape, ctr, fftgrad):
+        """Same as `gradient_helper`, but add the result, in Fourier
+        space, to `fftgrad` in place.
+
+        Contributions from several epochs can thus be summed before a
+        single inverse transform with `ifft_galaxy`.
+        """
+
+        with self._workspace() as ws:
+            self._gradient_fft(ws, x, shape, ctr, 1.)  # -> ws.fftout
+            fftgrad += ws.fftout
+
+    def _point_source_fft(self, pos, shape, ctr, grad):
+        """Evaluate a point source at the given position by shifting the
+        tabulated PSF in Fourier space (see `TabularPSF.point_source`)."""
+
         # shift necessary to put model onto data coordinates
         offset = yxoffset((self.ny, self.nx), shape, ctr)
-        fshift = fft_shift_phasor_2d((self.ny, self.nx),
-                                     (-offset[0], -offset[1]))
-        fshift = np.asarray(fshift, dtype=np.complex128)
+        yshift, xshift = -offset[0], -offset[1]
 
-        # create output array
-        out = np.zeros((self.nw, self.ny, self.nx), dtype=np.float64)
-        out[:, :x.shape[1], :x.shape[2]] = x
+        # Add shift to move point source from the lower left in the model array
+        # to `pos` in model *coordinates*. Note that in model coordinates,
+        # (0, 0) corresponds to array position (ny-1)/2., (nx-1)/2.
+        yshift += (self.ny - 1) / 2. + pos[0]
+        xshift += (self.nx - 1) / 2. + pos[1]
 
-        for i in range(self.nw):
-            tmp = ifft2(np.conj(self.fftconv[i, :, :] * fshift) *
-                        fft2(out[i, :, :]))
-            out[i, :, :] = tmp.real
+        # following is like irfft2(fftconv * fshift)
+        with self._workspace() as ws:
+            res = self._sample(ws, self.fftconv, shape, (yshift, xshift),
+                               grad=grad)
 
-        return out
+        if grad:
+            s, sgrad_shift = res
+            sgrad = np.empty((4,) + s.shape, dtype=self.dtype)
+            sgrad[0:2] = -sgrad_shift  # make derivatives w.r.t. `ctr`.
+            sgrad[2:4] = sgrad_shift
+            return s, sgrad
+
+        else:
+            return res
 
 
 class TabularPSF(PSFBase):
     """PSF represented by an array."""
 
-    def point_source(self, pos, shape, ctr, grad=False):
+    def point_source(self, pos, shape, ctr, grad=False, fourier=True):
         """Evaluate a point source at the given position.
 
         If grad is True, return a 2-tuple, with the second item being
         a 4-d array of gradient with respect to
         ctr[0], ctr[1], pos[0], pos[1].
+
+        The tabulated PSF is always shifted in Fourier space; `fourier`
+        is accepted for compatibility with `GaussianMoffatPSF`.
         """
+        return self._point_source_fft(pos, shape, ctr, grad)
 
-        # shift necessary to put model onto data coordinates
-        offset = yxoffset((self.ny, self.nx), shape, ctr)
-        yshift, xshift = -offset[0], -offset[1]
+    @classmethod
+    def batch(cls, A, threads=None, sampling='auto', dtype=np.float64,
+              compress=None):
+        """Create PSFs for several epochs at once.
 
-        # Add shift to move point source from the lower left in the model array
-        # to `pos` in model *coordinates*. Note that in model coordinates,
-        # (0, 0) corresponds to array position (ny-1)/2., (nx-1)/2.
-        yshift += (self.ny - 1) / 2. + pos[0]
-        xshift += (self.nx - 1) / 2. + pos[1]
+        The Fourier transforms of all the PSFs are done in one batch.
 
-        fshift = fft_shift_phasor_2d((self.ny, self.nx), (yshift, xshift),
-                                     grad=grad)
-        if grad:
-            fshift, fshiftgrad = fshift
-            fshiftgrad *= -1.  # make derivatives w.r.t. `ctr`.
-
-        # following block is like ifft2(fftconv * fshift)
-        np.copyto(self.fftout, self.fftconv)
-        self.fftout *= self.fftnorm * fshift
-        self.ifft.execute()
-        s = np.copy(self.fftin.real[:, 0:shape[0], 0:shape[1]])
-        
-        if grad:
-            sgrad = np.empty((4,) + s.shape, dtype=np.float64)
-            for i in (0, 1):
-                np.copyto(self.fftout, self.fftconv)
-                self.fftout *= self.fftnorm * fshiftgrad[i]
-                self.ifft.execute()
-                sgrad[i] = self.fftin.real[:, 0:shape[0], 0:shape[1]]
-            sgrad[2:4] = -sgrad[0:2]
-            return s, sgrad
+        Parameters
+        ----------
+        A : ndarray (4-d)
+            PSF of each epoch, shape (nepochs, nw, ny, nx).
+        threads, sampling, dtype, compress
+            See `PSFBase`.
 
-        else:
-            return s
+        Returns
+        -------
+        psfs : list of TabularPSF
+        """
+
+        if threads is None:
+            threads = default_threads(A.shape[1])
+        fftconv = _psf_fftconv(A, threads)
+        return [cls(A[i], threads=threads, sampling=sampling, dtype=dtype,
+                    fftconv=fftconv[i], compress=compress)
+                for i in range(len(A))]
+
+
+class PSFTemplates(object):
+    """Library of Gaussian + Moffat profiles on a grid of (alpha,
+    ellipticity).
+
+    The other Gaussian + Moffat parameters (sigma, beta and eta) must be
+    functions of alpha, given by `tied_params`. A profile at any alpha,
+    ellipticity and (sub-pixel) position is then obtained by linear
+    interpolation between templates at the surrounding grid points and
+    4-point Lagrange interpolation within the (oversampled) templates,
+    rather than by evaluating the profile itself.
+
+    Templates are pixel-integrated (``method='integrate'`` in
+    `gaussian_moffat_psf`) and are computed as needed, then kept.
+
+    Parameters
+    ----------
+    tied_params : callable
+        Function of alpha (1-d array) returning (sigma, beta, eta).
+    dalpha, dellipticity : float, optional
+        Grid spacing in alpha and ellipticity. Default is 0.05 for both.
+    oversample : int, optional
+        Number of template samples per pixel. Default is 8.
+    radius : int, optional
+        Extent of templates from the center, in pixels. The profile is
+        taken to be zero beyond this. Default is 24.
+    threads : int, optional
+        Number of threads used in evaluating profiles.
+
+    Templates can be pickled if `tied_params` can (i.e., if it is a
+    module-level function).
+    """
+
+    def __init__(self, tied_params, dalpha=0.05, dellipticity=0.05,
+                 oversample=8, radius=24, threads=1):
+        self.tied_params = tied_params
+        self.dalpha = dalpha
+        self.dellipticity = dellipticity
+        self.oversample = oversample
+        self.radius = radius
+        self.threads = threads
+
+        # Templates extend two samples beyond `radius` for the
+        # interpolation.
+        self._ntmpl = radius * oversample + 2
+        self._index = {}  # (ialpha, iellipticity) -> index in _templates
+        self._templates = np.empty((0, self._ntmpl, self._ntmpl))
+
+        # Serializes adding templates, so that concurrent `evaluate`
+        # calls compute each only once.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _make_templates(self, keys):
+        """Compute and store templates at grid points `keys`."""
+
+        o = self.oversample
+        n = (self._ntmpl - 1) // o + 1  # pixels needed
+
+        alpha = np.array([k[0] * self.dalpha for k in keys])
+        ellip = np.array([k[1] * self.dellipticity for k in keys])
+        sigma, beta, eta = self.tied_params(alpha)
+
+        # Evaluate at o * o subpixel offsets with the profile centered on
+        # pixel (0, 0), and interleave: the value at pixel (j, i) with
+        # center offset (-a/o, -b/o) is the template at (j*o + a, i*o + b).
+        offsets = -np.arange(o) / o - (n - 1) / 2.
+        tmpl = np.empty((len(keys), n * o, n * o))
+        for a in range(o):
+            for b in range(o):
+                m = len(keys)
+                A = gaussian_moffat_psf(sigma, alpha, beta, ellip, eta,
+                                        offsets[a] * np.ones(m),
+                                        offsets[b] * np.ones(m), (n, n),
+                                        threads=self.threads,
+                                        method='integrate')
+                tmpl[:, a::o, b::o] = A
+
+        start = len(self._templates)
+        self._templates = np.concatenate(
+            (self._templates, tmpl[:, :self._ntmpl, :self._ntmpl]))
+        for i, key in enumerate(keys):
+            self._index[key] = start + i
+
+    def evaluate(self, alpha, ellipticity, yctr, xctr, shape, grad=False,
+                 threads=None):
+        """Evaluate the PSF on each slice of a 3-d grid.
+
+        Parameters
+        ----------
+        alpha, ellipticity, yctr, xctr : ndarray (1-d)
+            Moffat width, ellipticity and position of center of PSF
+            relative to *center* of output array at each wavelength.
+        shape : 2-tuple
+            (ny, nx) of output array.
+        grad : bool, optional
+            Also return the derivatives with respect to yctr, xctr
+            (shape ``(2, nw, ny, nx)``).
+        threads : int, optional
+            Number of threads. Default is the `threads` attribute.
+
+        Returns
+        -------
+        psf : 3-d array
+            Shape is (nw, shape[0], shape[1]).
+        """
+
+        # bilinear interpolation in (alpha, ellipticity)
+        a = np.asarray(alpha, dtype=np.float64) / self.dalpha
+        e = np.asarray(ellipticity, dtype=np.float64) / self.dellipticity
+        if np.any(a < 1.) or np.any(e < 1.):
+            raise ValueError("alpha and ellipticity must be at least "
+                             "dalpha and dellipticity")
+        ia = np.floor(a).astype(np.intp)
+        ie = np.floor(e).astype(np.intp)
+        fa = a - ia
+        fe = e - ie
+
+        keys = [list(zip(ia + da, ie + de)) for da in (0, 1) for de in (0, 1)]
+        with self._lock:
+            new = sorted(set(k for ks in keys for k in ks) -
+                         set(self._index))
+            if len(new) > 0:
+                self._make_templates(new)
+            templates = self._templates
+            nodes = np.array([[self._index[k] for k in ks]
+                              for ks in keys]).T
+        coeffs = np.array([(1. - fa) * (1. - fe), (1. - fa) * fe,
+                           fa * (1. - fe), fa * fe]).T
+
+        return template_psf(templates, np.ascontiguousarray(nodes),
+                            np.ascontiguousarray(coeffs),
+                            np.asarray(yctr, dtype=np.float64),
+                            np.asarray(xctr, dtype=np.float64), shape,
+                            self.oversample, grad=grad,
+                            threads=(self.threads if threads is None
+                                     else threads))
 
 
 class GaussianMoffatPSF(PSFBase):
@@ -195,10 +1011,58 @@ class GaussianMoffatPSF(PSFBase):
     ----------
     ellipticity : ndarray (1-d)
     alpha : ndarray (1-d)
+    subpix : int, optional
+        Subpixel sampling (with ``method='sample'``).
+    method : {'sample', 'integrate', 'adaptive'}, optional
+        How the PSF is integrated over pixels: by sampling at ``subpix**2``
+        points per pixel, by (much more accurate) integration, or by
+        sampling with a number of points per pixel chosen to reach
+        accuracy `tol`. See `cubefit.psffuncs.gaussian_moffat_psf`.
+    tol : float, optional
+        Accuracy relative to the peak, for ``method='adaptive'``.
+    truncate : float, optional
+        If given, the PSF is only evaluated where it is above `truncate`
+        times its peak, and is zero elsewhere (normalized to account for
+        the flux outside). This saves time on grids much larger than the
+        PSF. See `cubefit.psffuncs.gaussian_moffat_psf`.
+    threads : int, optional
+        Number of threads used in FFTs and in evaluating the analytic
+        PSF. Default is given by `default_threads`.
+    sampling : {'auto', 'fft', 'dft'}, optional
+        See `PSFBase`.
+    dtype : numpy dtype, optional
+        Floating point type used in FFTs and model evaluation. See
+        `PSFBase`.
+    compress : float, optional
+        Relative error of compressed storage of the PSF. See `PSFBase`.
+    templates : PSFTemplates, optional
+        If given, the PSF is interpolated from these templates rather than
+        evaluated (and `subpix`, `method`, `tol` and `truncate` are
+        ignored). sigma,
+        beta and eta must match ``templates.tied_params(alpha)``.
     """
 
     def __init__(self, sigma, alpha, beta, ellipticity, eta, yctr, xctr,
-                 shape, subpix=1):
+                 shape, subpix=1, threads=None, sampling='auto',
+                 dtype=np.float64, method='sample', tol=1.e-4,
+                 templates=None, compress=None, truncate=None):
+
+        self._set_params(sigma, alpha, beta, ellipticity, eta, yctr, xctr,
+                         subpix, method, tol, truncate, templates)
+
+        if threads is None:
+            threads = default_threads(len(sigma))
+
+        # Set up tabular PSF for galaxy convolution
+        A = self._profile(yctr, xctr, shape, False, threads)
+        super(GaussianMoffatPSF, self).__init__(A, threads=threads,
+                                                sampling=sampling,
+                                                dtype=dtype,
+                                                compress=compress)
+
+    def _set_params(self, sigma, alpha, beta, ellipticity, eta, yctr, xctr,
+                    subpix, method, tol, truncate, templates):
+        """Check and store the profile parameters (see `__init__`)."""
 
         if not (len(sigma) == len(alpha) == len(beta) == len(ellipticity) ==
                 len(eta) == len(yctr) == len(xctr)):
@@ -216,19 +1080,101 @@ class GaussianMoffatPSF(PSFBase):
         self.xctr = xctr
 
         self.subpix = subpix
+        self.method = method
+        self.tol = tol
+        self.truncate = truncate
+        self.templates = templates
 
-        # Set up tabular PSF for galaxy convolution
-        A = gaussian_moffat_psf(sigma, alpha, beta, ellipticity, eta,
-                                yctr, xctr, shape, subpix=subpix)
-        super(GaussianMoffatPSF, self).__init__(A)
+        if templates is not None:
+            tied = templates.tied_params(np.asarray(alpha))
+            if not all(np.allclose(p, t) for p, t in zip((sigma, beta, eta),
+                                                        tied)):
+                raise ValueError("sigma, beta and eta do not match "
+                                 "templates.tied_params(alpha)")
+
+    @classmethod
+    def batch(cls, sigma, alpha, beta, ellipticity, eta, yctr, xctr, shape,
+              subpix=1, threads=None, sampling='auto', dtype=np.float64,
+              method='sample', tol=1.e-4, templates=None, compress=None,
+              truncate=None):
+        """Create PSFs for several epochs at once.
+
+        Parameters are as for `GaussianMoffatPSF`, except that the profile
+        parameters are 2-d arrays, of shape (nepochs, nw). The profiles of
+        all epochs are evaluated in a single (multi-threaded) call, and
+        their Fourier transforms are done in one batch.
+
+        Returns
+        -------
+        psfs : list of GaussianMoffatPSF
+        """
+
+        params = [np.asarray(p, dtype=np.float64)
+                  for p in (sigma, alpha, beta, ellipticity, eta, yctr, xctr)]
+        nepochs, nw = params[0].shape
+        if not all(p.shape == (nepochs, nw) for p in params):
+            raise ValueError("shape of input arrays must match")
+
+        if threads is None:
+            threads = default_threads(nw)
+
+        psfs = []
+        for i in range(nepochs):
+            psf = cls.__new__(cls)
+            psf._set_params(*([p[i] for p in params] +
+                              [subpix, method, tol, truncate, templates]))
+            psfs.append(psf)
+
+        # Evaluate all epochs as one long list of wavelengths.
+        allpsf = cls.__new__(cls)
+        allpsf._set_params(*([p.ravel() for p in params] +
+                             [subpix, method, tol, truncate, templates]))
+        A = allpsf._profile(allpsf.yctr, allpsf.xctr, shape, False, threads)
+        A = A.reshape((nepochs, nw) + A.shape[1:])
+        fftconv = _psf_fftconv(A, threads)
+
+        for i, psf in enumerate(psfs):
+            PSFBase.__init__(psf, A[i], threads=threads, sampling=sampling,
+                             dtype=dtype, fftconv=fftconv[i],
+                             compress=compress)
+
+        return psfs
+
+    def _profile(self, yctr, xctr, shape, grad, threads):
+        """Evaluate (or interpolate) the analytic PSF at centers yctr, xctr.
+        """
+        if self.templates is not None:
+            return self.templates.evaluate(self.alpha, self.ellipticity,
+                                           yctr, xctr, shape, grad=grad,
+                                           threads=threads)
+
+        return gaussian_moffat_psf(self.sigma, self.alpha, self.beta,
+                                   self.ellipticity, self.eta, yctr, xctr,
+                                   shape, subpix=self.subpix, grad=grad,
+                                   threads=threads, method=self.method,
+                                   tol=self.tol, truncate=self.truncate)
+
+    def point_source(self, pos, shape, ctr, grad=False, fourier=False):
+        """Evaluate a point source at the given position.
+
+        If grad is True, return a 2-tuple, with the second item being
+        a 4-d array of gradient with respect to
+        ctr[0], ctr[1], pos[0], pos[1].
+
+        By default, the analytic PSF is evaluated at the new position. If
+        `fourier` is True, the PSF already tabulated on the model grid is
+        instead shifted in Fourier space, as in `TabularPSF`. This is much
+        faster, but only approximate (the pixel-integrated PSF is not
+        band-limited and is periodic in the model grid), so is meant for
+        use within iterative fits.
+        """
+        if fourier:
+            return self._point_source_fft(pos, shape, ctr, grad)
 
-    def point_source(self, pos, shape, ctr, grad=False):
         yctr = self.yctr + pos[0] - ctr[0]
         xctr = self.xctr + pos[1] - ctr[1]
 
-        res = gaussian_moffat_psf(self.sigma, self.alpha, self.beta,
-                                  self.ellipticity, self.eta, yctr, xctr,
-                                  shape, subpix=self.subpix, grad=grad)
+        res = self._profile(yctr, xctr, shape, grad, self.threads)
 
         if grad:
             s, sgrad_pos = res
@@ -0,0 +1,20 @@
+"""Evaluation of Gaussian + Moffat PSF profiles on pixel grids.
+
+The functions here come from the compiled extension `cubefit._psffuncs`
+if it is available, and otherwise from the (slower) vectorized NumPy
+implementation in `cubefit._psffuncs_numpy`. `BACKEND` is 'cython' or
+'numpy' accordingly.
+"""
+
+import warnings
+
+try:
+    from ._psffuncs import gaussian_moffat_psf, template_psf
+    BACKEND = 'cython'
+except ImportError:
+    warnings.warn("compiled PSF functions (cubefit._psffuncs) not available; "
+                  "using slower NumPy implementation")
+    from ._psffuncs_numpy import gaussian_moffat_psf, template_psf
+    BACKEND = 'numpy'
+
+__all__ = ["gaussian_moffat_psf", "template_psf"]
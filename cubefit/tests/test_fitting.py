@@ -14,6 +14,7 @@ from scipy.optimize import check_grad, approx_fprime
 import cubefit
 from cubefit.fitting import (sky_and_sn,
                              chisq_galaxy_single,
+                             chisq_galaxy_sky_single,
                              chisq_galaxy_sky_multi,
                              chisq_position_sky_sn_multi)
 
@@ -70,6 +71,29 @@ def test_sky_and_sn():
     assert_allclose(sky, truesky)
     assert_allclose(sn, truesn)
 
+
+def test_sky_and_sn_gradient():
+    """Gradients of sky and SN match finite differences."""
+
+    rng = np.random.RandomState(0)
+    shape = (4, 5, 5)
+    data = rng.rand(*shape)
+    weight = rng.rand(*shape) + 0.5
+    g = rng.rand(*shape)
+    s = rng.rand(*shape)
+    ggrad = rng.rand(1, *shape)
+    sgrad = rng.rand(1, *shape)
+
+    sky, sn, skygrad, sngrad = cubefit.fitting.sky_and_sn(
+        data, weight, g, s, ggrad=ggrad, sgrad=sgrad)
+
+    h = 1.e-6
+    sky2, sn2 = cubefit.fitting.sky_and_sn(data, weight, g + h * ggrad[0],
+                                           s + h * sgrad[0])
+    assert_allclose(skygrad[0], (sky2 - sky) / h, rtol=1.e-4, atol=1.e-6)
+    assert_allclose(sngrad[0], (sn2 - sn) / h, rtol=1.e-4, atol=1.e-6)
+
+
 class TestFitting:
     def setup_class(self):
         """Create some dummy data and a PSF."""
@@ -109,6 +133,7 @@ class TestFitting:
         A = cubefit.psffuncs.gaussian_moffat_psf(sigma, alpha, beta, ellip,
                                                  eta, yctr, xctr, MODEL_SHAPE)
         self.psf = cubefit.TabularPSF(A)
+        self.A = A
 
         # create the data by convolving the true galaxy model with the psf
         # and taking a slice.
@@ -228,6 +253,56 @@ class TestFitting:
         assert_allclose(grad, fdgrad, rtol=0.005, atol=0.)
 
 
+    def test_chisq_galaxy_sky_multi_sum(self):
+        """Multi-epoch chi^2 and gradient (which share Fourier transforms
+        between epochs) equal the sum over single epochs."""
+
+        np.random.seed(0)
+        galaxy = np.random.rand(*self.galaxy.shape)
+        datas = [cube.data for cube in self.cubes]
+        weights = [cube.weight for cube in self.cubes]
+        ctrs = [(0., 0.), (1.2, -0.3), (-2., 0.5)]
+        psfs = [self.psf for cube in self.cubes]
+
+        val, grad = chisq_galaxy_sky_multi(galaxy, datas, weights, ctrs, psfs)
+
+        expval = 0.
+        expgrad = np.zeros_like(galaxy)
+        for data, weight, ctr, psf in zip(datas, weights, ctrs, psfs):
+            v, g = chisq_galaxy_sky_single(galaxy, data, weight, ctr, psf)
+            expval += v
+            expgrad += g
+
+        assert_allclose(val, expval)
+        assert_allclose(grad, expgrad, rtol=0., atol=1.e-10 *
+                        np.max(np.abs(expgrad)))
+
+    def test_chisq_galaxy_sky_multi_executor(self):
+        """Epochs evaluated in a thread pool give the same chi^2 and
+        gradient as serial evaluation."""
+
+        from multiprocessing.pool import ThreadPool
+
+        np.random.seed(0)
+        galaxy = np.random.rand(*self.galaxy.shape)
+        datas = [cube.data for cube in self.cubes] * 3
+        weights = [cube.weight for cube in self.cubes] * 3
+        ctrs = [(0., 0.), (1.2, -0.3), (-2., 0.5)] * 3
+        psfs = [self.psf for cube in self.cubes] * 3
+
+        val, grad = chisq_galaxy_sky_multi(galaxy, datas, weights, ctrs, psfs)
+        pool = ThreadPool(4)
+        try:
+            val2, grad2 = chisq_galaxy_sky_multi(galaxy, datas, weights, ctrs,
+                                                 psfs, executor=pool)
+        finally:
+            pool.close()
+            pool.join()
+
+        assert val2 == val
+        assert_allclose(grad2, grad, rtol=0., atol=1.e-12 *
+                        np.max(np.abs(grad)))
+
     def pixel_regpenalty_diff(self, regpenalty, galmodel, k, j, i, eps):
         """What is the difference in the regpenalty caused by changing
         galmodel[k, j, i] by EPS?"""
@@ -302,6 +377,164 @@ class TestFitting:
 
         psf = self.psf.point_source((0., 0.), (15, 15), (0., 0.))
         
+    def test_fit_position_sky_sn_multi_float32(self):
+        """Fitted positions and SN spectra agree between single and double
+        precision PSFs."""
+
+        psf32 = cubefit.TabularPSF(self.A, dtype=np.float32)
+        nt = len(self.cubes)
+        nw = self.galaxy.shape[0]
+        snctr = (0.5, -0.3)
+
+        # add a SN to the data
+        datas = []
+        for j, cube in enumerate(self.cubes):
+            ctr = (self.trueyctrs[j], self.truexctrs[j])
+            s = self.psf.point_source(snctr, (15, 15), ctr)
+            datas.append(cube.data + 3. * np.ones(nw)[:, None, None] * s)
+        weights = [cube.weight for cube in self.cubes]
+
+        results = []
+        for psf in (self.psf, psf32):
+            res = cubefit.fit_position_sky_sn_multi(
+                self.truegal, datas, weights, self.trueyctrs + 0.2,
+                self.truexctrs - 0.2, (0., 0.), nt * [psf], 1.e7,
+                [(-8., 8.)] * nt, [(-8., 8.)] * nt, (-3., 3.))
+            results.append(res)
+        fyctr64, fxctr64, fsnctr64, _, sne64 = results[0]
+        fyctr32, fxctr32, fsnctr32, _, sne32 = results[1]
+
+        assert_allclose(fyctr32, fyctr64, atol=1.e-3)
+        assert_allclose(fxctr32, fxctr64, atol=1.e-3)
+        assert_allclose(fsnctr32, fsnctr64, atol=1.e-3)
+        assert_allclose(sne32, sne64, rtol=1.e-3)
+
+    def test_fit_position_sky_sn_multi_block(self):
+        """The block method (with and without an executor) recovers the
+        true positions and SN spectrum."""
+
+        from multiprocessing.pool import ThreadPool
+
+        nt = len(self.cubes)
+        nw = self.galaxy.shape[0]
+        snctr = (0.5, -0.3)
+
+        datas = []
+        for j, cube in enumerate(self.cubes):
+            ctr = (self.trueyctrs[j], self.truexctrs[j])
+            s = self.psf.point_source(snctr, (15, 15), ctr)
+            datas.append(cube.data + 3. * np.ones(nw)[:, None, None] * s)
+        weights = [cube.weight for cube in self.cubes]
+
+        pool = ThreadPool(2)
+        results = []
+        for executor in (None, pool):
+            res = cubefit.fit_position_sky_sn_multi(
+                self.truegal, datas, weights, self.trueyctrs + 0.2,
+                self.truexctrs - 0.2, (0., 0.), nt * [self.psf], 1.e7,
+                [(-8., 8.)] * nt, [(-8., 8.)] * nt, (-3., 3.),
+                method='block', executor=executor)
+            results.append(res)
+        pool.close()
+
+        # The data are noiseless, so the minimum is at the truth.
+        fyctr, fxctr, fsnctr, _, sne = results[0]
+        assert_allclose(fyctr, self.trueyctrs, atol=1.e-4)
+        assert_allclose(fxctr, self.truexctrs, atol=1.e-4)
+        assert_allclose(fsnctr, snctr, atol=1.e-4)
+        assert_allclose(sne, 3., rtol=1.e-3)
+        for i in (0, 1, 2, 4):
+            assert_allclose(results[1][i], results[0][i], rtol=0.,
+                            atol=1.e-12)
+
+        try:
+            cubefit.fit_position_sky_sn_multi(
+                self.truegal, datas, weights, self.trueyctrs,
+                self.truexctrs, (0., 0.), nt * [self.psf], 1.e7,
+                [(-8., 8.)] * nt, [(-8., 8.)] * nt, (-3., 3.),
+                method='alternate')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError for unknown method")
+
+        try:
+            cubefit.fit_position_sky_sn_multi(
+                self.truegal, datas, weights, self.trueyctrs + 0.2,
+                self.truexctrs - 0.2, (0., 0.), nt * [self.psf], 1.e7,
+                [(-8., 8.)] * nt, [(-8., 8.)] * nt, (-3., 3.),
+                method='block', maxiter=1)
+        except RuntimeError as e:
+            assert "_fit_position_sky_sn_block()" in str(e)
+        else:
+            raise AssertionError("expected RuntimeError at maxiter")
+
+    def test_fit_position_sky_sn_multi_block_bounds(self):
+        """The block method converges to the same minimum as the joint
+        method when the SN position ends up on a bound."""
+
+        nt = len(self.cubes)
+        nw = self.galaxy.shape[0]
+        snctr = (0.5, -0.3)
+        psfs = nt * [self.psf]
+        weights = [cube.weight for cube in self.cubes]
+
+        # noiseless data with the true SN x outside the bounds, and noisy
+        # data where the best-fit SN position is on the edge.
+        for sigma, snctrbounds in ((0., [(-3., 3.), (-3., -0.5)]),
+                                   (0.05, (-3., 3.))):
+            rng = np.random.RandomState(0)
+            datas = []
+            for j, cube in enumerate(self.cubes):
+                ctr = (self.trueyctrs[j], self.truexctrs[j])
+                s = self.psf.point_source(snctr, (15, 15), ctr)
+                datas.append(cube.data + 3. * np.ones(nw)[:, None, None] * s
+                             + sigma * rng.randn(*cube.data.shape))
+
+            results = {}
+            for method in ('joint', 'block'):
+                fyctr, fxctr, fsnctr, _, _ = cubefit.fit_position_sky_sn_multi(
+                    self.truegal, datas, weights, self.trueyctrs + 0.2,
+                    self.truexctrs - 0.2, (0., 0.), psfs, 1.e7,
+                    [(-8., 8.)] * nt, [(-8., 8.)] * nt, snctrbounds,
+                    method=method)
+                allctrs = np.hstack((np.column_stack((fyctr, fxctr)).ravel(),
+                                     fsnctr))
+                chisq, _ = chisq_position_sky_sn_multi(
+                    allctrs, self.truegal, datas, weights, psfs)
+                results[method] = allctrs, chisq
+
+            # SN x position is on a bound in both.
+            assert np.any(results['block'][0][-1] == [-3., -0.5, 3.])
+            assert_allclose(results['block'][0], results['joint'][0],
+                            atol=5.e-3)
+            assert_allclose(results['block'][1], results['joint'][1],
+                            rtol=1.e-7, atol=1.e-8)
+
+    def test_fit_position_sky_pool(self):
+        """Positions fit in worker processes match serial fits, and
+        recover the true positions."""
+
+        nt = len(self.cubes)
+        datas = [cube.data for cube in self.cubes]
+        weights = [cube.weight for cube in self.cubes]
+        ctrs0 = [(y + 0.3, x - 0.2)
+                 for y, x in zip(self.trueyctrs, self.truexctrs)]
+        bounds = nt * [[(-8., 8.), (-8., 8.)]]
+
+        ctrs, skys = cubefit.fit_position_sky_pool(
+            self.truegal, datas, weights, ctrs0, nt * [self.psf], bounds,
+            processes=1)
+        ctrs2, skys2 = cubefit.fit_position_sky_pool(
+            self.truegal, datas, weights, ctrs0, nt * [self.psf], bounds,
+            processes=2)
+
+        assert ctrs2 == ctrs
+        for sky, sky2 in zip(skys, skys2):
+            assert_allclose(sky2, sky, rtol=0., atol=1.e-12)
+        assert_allclose([c[0] for c in ctrs], self.trueyctrs, atol=1.e-2)
+        assert_allclose([c[1] for c in ctrs], self.truexctrs, atol=1.e-2)
+
     def test_fit_position_grad(self):
         """Test the gradient of the sn and sky position fitting function
         """
@@ -1,9 +1,16 @@
 """PSF tests."""
 
+import os
+import pickle
+import shutil
+import tempfile
+
 import numpy as np
+from numpy.fft import fft2, ifft2
 from numpy.testing import assert_allclose
 
 import cubefit
+from cubefit.main import snf_tied_params
 from . import psffuncs_pure
 
 def get_gaussian_moffat_psf(subpix):
@@ -22,6 +29,289 @@ def get_gaussian_moffat_psf(subpix):
                                      yctr, xctr, (32, 32), subpix=subpix)
 
 
+def test_gaussian_moffat_psf_threads():
+    """Multi-threaded PSF evaluation gives identical results."""
+
+    psf = get_gaussian_moffat_psf(3)
+    args = (psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta,
+            psf.yctr, psf.xctr, (15, 15))
+    A, Agrad = cubefit.psffuncs.gaussian_moffat_psf(*args, subpix=3,
+                                                    grad=True, threads=1)
+    B, Bgrad = cubefit.psffuncs.gaussian_moffat_psf(*args, subpix=3,
+                                                    grad=True, threads=4)
+    assert np.all(A == B)
+    assert np.all(Agrad == Bgrad)
+
+
+def test_gaussian_moffat_psf_grad():
+    """Value-only and value+gradient kernels agree, and the gradient
+    matches finite differences."""
+
+    psf = get_gaussian_moffat_psf(3)
+    args = (psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta)
+    f = cubefit.psffuncs.gaussian_moffat_psf
+
+    A = f(*(args + (psf.yctr, psf.xctr, (15, 13))), subpix=3)
+    B, Bgrad = f(*(args + (psf.yctr, psf.xctr, (15, 13))), subpix=3,
+                 grad=True)
+    assert_allclose(B, A, rtol=1.e-14)
+
+    h = 1.e-6
+    Ay = f(*(args + (psf.yctr + h, psf.xctr, (15, 13))), subpix=3)
+    Ax = f(*(args + (psf.yctr, psf.xctr + h, (15, 13))), subpix=3)
+    assert_allclose(Bgrad[0], (Ay - A) / h, rtol=0., atol=1.e-6)
+    assert_allclose(Bgrad[1], (Ax - A) / h, rtol=0., atol=1.e-6)
+
+
+def test_gaussian_moffat_psf_integrate():
+    """Integrating over pixels agrees with sampling with many subpixels."""
+
+    psf = get_gaussian_moffat_psf(1)
+    args = (psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta)
+    f = cubefit.psffuncs.gaussian_moffat_psf
+
+    A, Agrad = f(*(args + (psf.yctr, psf.xctr, (15, 13))),
+                 method='integrate', grad=True)
+    B, Bgrad = f(*(args + (psf.yctr, psf.xctr, (15, 13))), subpix=41,
+                 grad=True)
+    assert_allclose(A, B, rtol=0., atol=1.e-4 * np.max(B))
+    assert_allclose(Agrad, Bgrad, rtol=0., atol=2.e-4 * np.max(B))
+    assert_allclose(f(*(args + (psf.yctr, psf.xctr, (15, 13))),
+                      method='integrate'), A, rtol=1.e-14)
+
+
+def test_gaussian_moffat_psf_adaptive():
+    """Adaptive subpixel sampling reaches the requested accuracy.
+
+    The reference is the pure Python implementation evaluated on a grid
+    oversampled by a factor of 45 and summed into pixels."""
+
+    psf = get_gaussian_moffat_psf(1)
+    shape = (15, 13)
+    n = 45
+    B = psffuncs_pure.gaussian_moffat_psf(
+        n * psf.sigma, n * psf.alpha, psf.beta, psf.ellipticity, psf.eta,
+        n * psf.yctr, n * psf.xctr, (n * shape[0], n * shape[1]))
+    B = B.reshape(-1, shape[0], n, shape[1], n).sum(axis=(2, 4))
+
+    # (peak value of each slice)
+    peak = cubefit.psffuncs.gaussian_moffat_psf(
+        psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta,
+        np.zeros(4), np.zeros(4), (1, 1))[:, 0, 0]
+
+    for tol in (1.e-2, 1.e-3):
+        A = cubefit.psffuncs.gaussian_moffat_psf(
+            psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta,
+            psf.yctr, psf.xctr, shape, method='adaptive', tol=tol)
+        assert np.all(np.abs(A - B) < tol * peak[:, None, None])
+
+    A, Agrad = cubefit.psffuncs.gaussian_moffat_psf(
+        psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta,
+        psf.yctr, psf.xctr, shape, method='adaptive', grad=True)
+    Bgrad = cubefit.psffuncs.gaussian_moffat_psf(
+        psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta,
+        psf.yctr, psf.xctr, shape, method='integrate', grad=True)[1]
+    assert_allclose(Agrad, Bgrad, rtol=0., atol=1.e-3 * np.max(peak))
+
+
+def test_gaussian_moffat_psf_truncate():
+    """Truncated evaluation is zero outside the profile core, matches
+    full evaluation (up to normalization) inside it and restores the
+    flux of the tail."""
+
+    psf = get_gaussian_moffat_psf(1)
+    args = (psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta,
+            psf.yctr, psf.xctr, (64, 64))
+    f = cubefit.psffuncs.gaussian_moffat_psf
+
+    A, Agrad = f(*args, method='integrate', grad=True)
+    B, Bgrad = f(*args, method='integrate', grad=True, truncate=1.e-4)
+    inside = B != 0.
+    assert 0.5 < np.mean(~inside) < 1.
+    assert np.all(Bgrad[:, ~inside] == 0.)
+
+    # inside, values are scaled by a constant at each wavelength.
+    scale = B.sum(axis=(1, 2)) / np.sum(np.where(inside, A, 0.), axis=(1, 2))
+    assert np.all(scale > 1.)
+    assert_allclose(B, np.where(inside, A * scale[:, None, None], 0.),
+                    rtol=1.e-14)
+    assert_allclose(Bgrad, np.where(inside, Agrad * scale[:, None, None], 0.),
+                    rtol=1.e-14)
+
+    # (the full evaluation misses some of the tail, even on this grid.)
+    assert np.all(np.abs(B.sum(axis=(1, 2)) - 1.) <
+                  np.abs(A.sum(axis=(1, 2)) - 1.))
+
+    try:
+        f(*args, truncate=2.)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError")
+
+
+def test_psf_templates():
+    """PSFs interpolated from templates match integrated evaluation."""
+
+    nw = 6
+    alpha = np.linspace(2.2, 1.8, nw)
+    ellip = np.array([1.0, 1.2, 1.33, 1.5, 1.6, 2.0])
+    sigma, beta, eta = snf_tied_params(alpha)
+    yctr = np.linspace(-1., 1., nw)
+    xctr = np.linspace(0.7, -0.3, nw)
+    shape = (15, 13)
+
+    templates = cubefit.PSFTemplates(snf_tied_params)
+    A, Agrad = templates.evaluate(alpha, ellip, yctr, xctr, shape, grad=True)
+    B, Bgrad = cubefit.psffuncs.gaussian_moffat_psf(
+        sigma, alpha, beta, ellip, eta, yctr, xctr, shape,
+        method='integrate', grad=True)
+    peak = np.max(B)
+    assert_allclose(A, B, rtol=0., atol=3.e-4 * peak)
+    assert_allclose(Agrad, Bgrad, rtol=0., atol=3.e-3 * peak)
+
+    # templates are only computed once
+    n = len(templates)
+    templates.evaluate(alpha, ellip, yctr, xctr, shape)
+    assert len(templates) == n
+
+    # used in GaussianMoffatPSF
+    psf = cubefit.GaussianMoffatPSF(sigma, alpha, beta, ellip, eta, yctr,
+                                    xctr, (32, 32), templates=templates)
+    C, Cgrad = psf.point_source((0.5, 0.5), shape, (0., 0.), grad=True)
+    assert_allclose(C, templates.evaluate(alpha, ellip, yctr + 0.5,
+                                          xctr + 0.5, shape))
+    assert_allclose(Cgrad[2:4], -Cgrad[0:2])
+
+    # parameters must be consistent with templates
+    try:
+        cubefit.GaussianMoffatPSF(sigma, alpha, 2. * beta, ellip, eta, yctr,
+                                  xctr, (32, 32), templates=templates)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError")
+
+
+def test_gaussian_moffat_point_source_fourier():
+    """Fourier-shifted point source matches the TabularPSF of the same
+    array and (for a wide PSF) the analytic point source."""
+
+    nw = 4
+    alpha = 4. * np.ones(nw)
+    sigma = 0.545 + 0.215 * alpha
+    beta = 1.685 + 0.345 * alpha
+    ellip = np.array([1.0, 1.2, 1.5, 2.0])
+    eta = 1.04 * np.ones(nw)
+    yctr = np.array([0., 0.5, 1.0, 1.5])
+    xctr = np.array([0., -0.5, 0.25, 1.5])
+    psf = cubefit.GaussianMoffatPSF(sigma, alpha, beta, ellip, eta, yctr,
+                                    xctr, (32, 32), method='integrate')
+    tpsf = cubefit.TabularPSF(cubefit.psffuncs.gaussian_moffat_psf(
+        sigma, alpha, beta, ellip, eta, yctr, xctr, (32, 32),
+        method='integrate'))
+
+    pos = (0.3, -0.4)
+    ctr = (0.2, 0.1)
+    A, Agrad = psf.point_source(pos, (15, 13), ctr, grad=True, fourier=True)
+    B, Bgrad = tpsf.point_source(pos, (15, 13), ctr, grad=True)
+    assert_allclose(A, B)
+    assert_allclose(Agrad, Bgrad)
+
+    C, Cgrad = psf.point_source(pos, (15, 13), ctr, grad=True)
+    assert_allclose(A, C, rtol=0., atol=2.e-3 * np.max(C))
+    assert_allclose(Agrad, Cgrad, rtol=0., atol=5.e-3 * np.max(C))
+
+
+def test_psf_batch():
+    """PSFs constructed in a batch match those constructed one at a
+    time."""
+
+    psf = get_gaussian_moffat_psf(3)
+    params = [np.array([p, p[::-1]]) for p in
+              (psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta,
+               psf.yctr, psf.xctr)]
+
+    psfs = cubefit.GaussianMoffatPSF.batch(*params, shape=(32, 32), subpix=3)
+    assert len(psfs) == 2
+    for i in range(2):
+        psf = cubefit.GaussianMoffatPSF(*([p[i] for p in params] +
+                                          [(32, 32)]), subpix=3)
+        assert_allclose(psfs[i].fftconv, psf.fftconv, rtol=0., atol=1.e-14)
+        assert_allclose(psfs[i].point_source((0.5, 0.), (15, 15), (0., 0.)),
+                        psf.point_source((0.5, 0.), (15, 15), (0., 0.)))
+
+    A = np.random.rand(3, 4, 32, 32)
+    psfs = cubefit.TabularPSF.batch(A)
+    for i in range(3):
+        assert_allclose(psfs[i].fftconv, cubefit.TabularPSF(A[i]).fftconv,
+                        rtol=0., atol=1.e-12)
+
+
+def test_psf_compress():
+    """Compressed PSF storage meets its error bound."""
+
+    nw = 100
+    alpha = np.linspace(2.2, 1.8, nw)
+    sigma = 0.545 + 0.215 * alpha
+    beta = 1.685 + 0.345 * alpha
+    ellip = 1.3 * np.ones(nw)
+    eta = 1.04 * np.ones(nw)
+    yctr = np.linspace(-1., 1.5, nw)
+    xctr = np.linspace(1., -0.5, nw)
+    args = (sigma, alpha, beta, ellip, eta, yctr, xctr, (32, 32))
+
+    psf = cubefit.GaussianMoffatPSF(*args, subpix=3)
+    tol = 1.e-4
+    cpsf = cubefit.GaussianMoffatPSF(*args, subpix=3, compress=tol)
+    lr = cpsf._fftconv_lr
+    assert lr.rank < 20
+    assert lr.nbytes < psf.fftconv.nbytes / 5
+
+    # relative RMS error of the PSF at each wavelength
+    A = np.fft.irfft2(psf.fftconv, s=(32, 32))
+    B = np.fft.irfft2(cpsf.fftconv, s=(32, 32))
+    rms = lambda x: np.sqrt(np.mean(x**2, axis=(1, 2)))
+    assert np.all(rms(A - B) <= 1.0001 * tol * rms(A))
+
+    galaxy = np.random.rand(nw, 32, 32)
+    g = psf.evaluate_galaxy(galaxy, (15, 15), (0.5, -0.5))
+    gc = cpsf.evaluate_galaxy(galaxy, (15, 15), (0.5, -0.5))
+    assert_allclose(gc, g, rtol=0., atol=10. * tol * np.max(g))
+
+
+def test_numpy_backend():
+    """NumPy implementation of psffuncs matches the compiled one."""
+
+    from cubefit import _psffuncs_numpy
+
+    psf = get_gaussian_moffat_psf(1)
+    args = (psf.sigma, psf.alpha, psf.beta, psf.ellipticity, psf.eta,
+            psf.yctr, psf.xctr, (15, 13))
+    for kwargs in ({'subpix': 1}, {'subpix': 3}, {'method': 'integrate'},
+                   {'method': 'adaptive', 'tol': 1.e-3},
+                   {'subpix': 3, 'truncate': 1.e-3}):
+        A = cubefit.psffuncs.gaussian_moffat_psf(*args, **kwargs)
+        B = _psffuncs_numpy.gaussian_moffat_psf(*args, **kwargs)
+        assert_allclose(A, B, rtol=1.e-12, atol=1.e-15)
+
+        A, Agrad = cubefit.psffuncs.gaussian_moffat_psf(*args, grad=True,
+                                                        **kwargs)
+        B, Bgrad = _psffuncs_numpy.gaussian_moffat_psf(*args, grad=True,
+                                                       **kwargs)
+        assert_allclose(A, B, rtol=1.e-12, atol=1.e-15)
+        assert_allclose(Agrad, Bgrad, rtol=1.e-12, atol=1.e-15)
+
+    templates = np.random.rand(3, 20, 20)
+    nodes = np.array([[0, 1], [1, 2], [2, 0], [0, 0]])
+    coeffs = np.random.rand(4, 2)
+    args = (templates, nodes, coeffs, psf.yctr, psf.xctr, (15, 13), 2)
+    A, Agrad = cubefit.psffuncs.template_psf(*args, grad=True)
+    B, Bgrad = _psffuncs_numpy.template_psf(*args, grad=True)
+    assert_allclose(A, B, rtol=1.e-12)
+    assert_allclose(Agrad, Bgrad, rtol=1.e-12)
+
+
 def test_gaussian_moffat_norm():
     """Test normalization. of GaussMoffatPSF"""
 
@@ -34,6 +324,12 @@ def test_gaussian_moffat_norm():
 
     assert_allclose(sums, 1., rtol=0.0005)
 
+    psf = cubefit.GaussianMoffatPSF(psf.sigma, psf.alpha, psf.beta,
+                                    psf.ellipticity, psf.eta, psf.yctr,
+                                    psf.xctr, (32, 32), method='integrate')
+    A = psf.point_source((0., 0.), (100, 100), (0., 0.))
+    assert_allclose(A.sum(axis=(1, 2)), 1., rtol=0.0005)
+
 
 def test_comparison_to_pure_python():
     psf = get_gaussian_moffat_psf(1)
@@ -79,3 +375,291 @@ def test_old_version():
                                          MODEL_SHAPE)
 
     assert_allclose(A, B, rtol=1.e-2)
+
+
+def test_half_spectrum_phasor():
+    """Half-spectrum shift phasor matches the non-negative frequencies of
+    the full phasor."""
+
+    for shape in [(32, 32), (15, 17)]:
+        full, fullgrad = cubefit.fft_shift_phasor_2d(shape, (1.3, -2.7),
+                                                     grad=True)
+        half, halfgrad = cubefit.fft_shift_phasor_2d(shape, (1.3, -2.7),
+                                                     grad=True, half=True)
+        n = shape[1] // 2 + 1
+        assert half.shape == (shape[0], n)
+        assert_allclose(half.real, full[:, 0:n].real, atol=1.e-15)
+        assert_allclose(halfgrad.real, fullgrad[:, :, 0:n].real, atol=1.e-13)
+
+        # imaginary parts differ only at the Nyquist frequency (if any).
+        m = n - 1 if shape[1] % 2 == 0 else n
+        assert_allclose(half[:, 0:m], full[:, 0:m], atol=1.e-15)
+
+
+def test_tabular_psf_evaluate_galaxy():
+    """Compare real-to-complex convolution to a full complex FFT."""
+
+    psf = get_gaussian_moffat_psf(1)
+    A = psffuncs_pure.gaussian_moffat_psf(psf.sigma, psf.alpha, psf.beta,
+                                          psf.ellipticity, psf.eta, psf.yctr,
+                                          psf.xctr, (32, 32))
+    tpsf = cubefit.TabularPSF(A)
+    assert tpsf.fftconv.shape == (4, 32, 17)
+
+    np.random.seed(0)
+    galaxy = np.random.rand(4, 32, 32)
+    ctr = (1.3, -2.7)
+    gal = tpsf.evaluate_galaxy(galaxy, (15, 15), ctr)
+
+    offset = cubefit.yxoffset((32, 32), (15, 15), ctr)
+    fshift1 = cubefit.fft_shift_phasor_2d((32, 32), (-15.5, -15.5))
+    fshift2 = cubefit.fft_shift_phasor_2d((32, 32), (-offset[0], -offset[1]))
+    expected = ifft2(fft2(A) * fshift1 * fft2(galaxy) * fshift2).real
+    expected = expected[:, 0:15, 0:15]
+
+    assert_allclose(gal, expected, rtol=0., atol=1.e-12 * np.max(expected))
+
+
+def test_threads():
+    """Multi-threaded FFTs give the same result as a single thread."""
+
+    psf = get_gaussian_moffat_psf(1)
+    A = psf.point_source((0., 0.), (32, 32), (0., 0.))
+    psf1 = cubefit.TabularPSF(A, threads=1)
+    psf4 = cubefit.TabularPSF(A, threads=4)
+
+    np.random.seed(0)
+    galaxy = np.random.rand(4, 32, 32)
+    assert_allclose(psf4.evaluate_galaxy(galaxy, (15, 15), (0.5, 1.)),
+                    psf1.evaluate_galaxy(galaxy, (15, 15), (0.5, 1.)))
+
+
+def test_gradient_helper_is_adjoint():
+    """gradient_helper is the transpose of evaluate_galaxy:
+    <evaluate_galaxy(g), x> == <g, gradient_helper(x)>."""
+
+    psf = get_gaussian_moffat_psf(1)
+
+    np.random.seed(0)
+    galaxy = np.random.rand(4, 32, 32)
+    x = np.random.rand(4, 15, 15)
+    ctr = (1.3, -2.7)
+
+    lhs = np.sum(psf.evaluate_galaxy(galaxy, (15, 15), ctr) * x)
+    rhs = np.sum(galaxy * psf.gradient_helper(x, (15, 15), ctr))
+    assert_allclose(lhs, rhs, rtol=1.e-12)
+
+
+def test_cache_galaxy():
+    """Evaluating a cached galaxy model gives the same result."""
+
+    psf = get_gaussian_moffat_psf(1)
+
+    np.random.seed(0)
+    galaxy = np.random.rand(4, 32, 32)
+    ctr = (1.3, -2.7)
+    g, ggrad = psf.evaluate_galaxy(galaxy, (15, 15), ctr, grad=True)
+
+    psf.cache_galaxy(galaxy)
+    g2, ggrad2 = psf.evaluate_galaxy(galaxy, (15, 15), ctr, grad=True)
+    g3 = psf.evaluate_galaxy(2. * galaxy, (15, 15), ctr)  # not cached
+    psf.clear_galaxy_cache()
+
+    assert_allclose(g2, g, rtol=1.e-14)
+    assert_allclose(ggrad2, ggrad, rtol=1.e-14)
+    assert_allclose(g3, 2. * g, rtol=1.e-12)
+
+
+def test_dft_sampling():
+    """Partial-DFT sampling matches FFT sampling, including gradients and
+    the adjoint."""
+
+    psf = get_gaussian_moffat_psf(1)
+    A = psf.point_source((0., 0.), (32, 32), (0., 0.))
+    psf_fft = cubefit.TabularPSF(A, sampling='fft')
+    psf_dft = cubefit.TabularPSF(A, sampling='dft')
+
+    np.random.seed(0)
+    galaxy = np.random.rand(4, 32, 32)
+    x = np.random.rand(4, 15, 13)
+    ctr = (1.3, -2.7)
+
+    g, ggrad = psf_fft.evaluate_galaxy(galaxy, (15, 13), ctr, grad=True)
+    g2, ggrad2 = psf_dft.evaluate_galaxy(galaxy, (15, 13), ctr, grad=True)
+    assert_allclose(g2, g, rtol=0., atol=1.e-13)
+    assert_allclose(ggrad2, ggrad, rtol=0., atol=1.e-13)
+
+    s, sgrad = psf_fft.point_source((0.4, -0.6), (15, 13), ctr, grad=True)
+    s2, sgrad2 = psf_dft.point_source((0.4, -0.6), (15, 13), ctr, grad=True)
+    assert_allclose(s2, s, rtol=0., atol=1.e-15)
+    assert_allclose(sgrad2, sgrad, rtol=0., atol=1.e-15)
+
+    assert_allclose(psf_dft.gradient_helper(x, (15, 13), ctr),
+                    psf_fft.gradient_helper(x, (15, 13), ctr),
+                    rtol=0., atol=1.e-13)
+
+
+def test_wisdom():
+    """FFTW wisdom is saved to and loaded from a cache directory."""
+
+    dirname = tempfile.mkdtemp(prefix='cubefit')
+    fname = os.path.join(dirname, cubefit.psf.WISDOM_FNAME)
+    newkey = ((2, 8, 8), 'float64', 1, 'FFTW_ESTIMATE')
+    try:
+        cubefit.load_wisdom(dirname)
+        get_gaussian_moffat_psf(1)
+        cubefit.save_wisdom()
+        assert os.listdir(dirname) == [cubefit.psf.WISDOM_FNAME]
+        with open(fname, "rb") as f:
+            keys, _ = pickle.load(f)
+        assert ((4, 32, 32), 'float64') in [key[0:2] for key in keys]
+
+        # reloading works, and the file is not rewritten without new plans.
+        ino = os.stat(fname).st_ino
+        cubefit.load_wisdom(dirname)
+        cubefit.save_wisdom()
+        assert os.listdir(dirname) == [cubefit.psf.WISDOM_FNAME]
+        assert os.stat(fname).st_ino == ino
+
+        # a new plan type is merged into the same file.
+        cubefit.psf._wisdom_keys.add(newkey)
+        cubefit.save_wisdom()
+        assert os.listdir(dirname) == [cubefit.psf.WISDOM_FNAME]
+        with open(fname, "rb") as f:
+            newkeys, _ = pickle.load(f)
+        assert set(newkeys) == set(keys) | {newkey}
+    finally:
+        cubefit.psf._wisdom_keys.discard(newkey)
+        cubefit.psf._wisdom_dir = None
+        cubefit.psf._wisdom_saved_keys.clear()
+        shutil.rmtree(dirname)
+
+
+def test_planner_effort():
+    cubefit.set_planner_effort('estimate')
+    try:
+        psf = get_gaussian_moffat_psf(1)
+        with psf._workspace() as ws:
+            assert 'FFTW_ESTIMATE' in ws.fft.flags
+    finally:
+        cubefit.set_planner_effort('measure')
+
+
+def test_workspace_pool():
+    """PSFs of the same shape share FFT workspaces."""
+
+    pool = cubefit.psf._workspace_pool
+    psf = get_gaussian_moffat_psf(1)
+    A = psf.point_source((0., 0.), (32, 32), (0., 0.))
+    psfs = [cubefit.TabularPSF(A, threads=1) for _ in range(5)]
+    key = psfs[0]._wskey
+    n = pool.size(key)
+
+    np.random.seed(0)
+    galaxy = np.random.rand(4, 32, 32)
+    results = [p.evaluate_galaxy(galaxy, (15, 15), (0.5, 1.)) for p in psfs]
+    assert pool.size(key) == n >= 1
+    for res in results[1:]:
+        assert_allclose(res, results[0])
+
+    # concurrent use creates a second workspace
+    with psfs[0]._workspace() as ws1:
+        with psfs[1]._workspace() as ws2:
+            assert ws1 is not ws2
+    assert pool.size(key) >= 2
+
+
+def test_psf_reentrant():
+    """One PSF evaluated from many threads at once gives the same results
+    as serial evaluation."""
+
+    from multiprocessing.pool import ThreadPool
+
+    alpha = np.array([2.2, 2.0, 1.9, 1.8])
+    sigma, beta, eta = snf_tied_params(alpha)
+    args = (sigma, alpha, beta, np.array([1.0, 1.2, 1.5, 2.0]), eta,
+            np.array([0., 0.5, 1.0, 1.5]), np.array([0., -0.5, 0.25, 1.5]),
+            (32, 32))
+    A = cubefit.psffuncs.gaussian_moffat_psf(*args)
+
+    templates = cubefit.PSFTemplates(snf_tied_params, oversample=4,
+                                     radius=8)
+    psfs = [cubefit.TabularPSF(A, threads=1, sampling='fft'),
+            cubefit.TabularPSF(A, threads=1, sampling='dft'),
+            cubefit.GaussianMoffatPSF(*args, threads=1),
+            cubefit.GaussianMoffatPSF(*args, threads=1, templates=templates)]
+
+    np.random.seed(0)
+    galaxy = np.random.rand(4, 32, 32)
+    x = np.random.rand(4, 15, 13)
+
+    def task(args):
+        i, k = args
+        psf = psfs[i % len(psfs)]
+        ctr = (0.1 * k, -0.2 * k)
+        g, ggrad = psf.evaluate_galaxy(galaxy, (15, 13), ctr, grad=True)
+        s, sgrad = psf.point_source((0.3, -0.1 * k), (15, 13), ctr,
+                                    grad=True)
+        return g, ggrad, s, sgrad, psf.gradient_helper(x, (15, 13), ctr)
+
+    tasks = [(i, k) for i in range(len(psfs)) for k in range(8)]
+    pool = ThreadPool(8)
+    try:
+        results = pool.map(task, tasks * 8)
+    finally:
+        pool.close()
+        pool.join()
+
+    expected = [task(t) for t in tasks]
+    for j, res in enumerate(results):
+        for a, b in zip(res, expected[j % len(tasks)]):
+            assert_allclose(a, b, rtol=1.e-12, atol=1.e-15)
+
+
+def _psf_results(args):
+    """Evaluate a PSF, for `test_psf_pickle`."""
+    psf, galaxy = args
+    return (psf.evaluate_galaxy(galaxy, (15, 13), (0.5, -1.), grad=True),
+            psf.point_source((0.3, 0.2), (15, 13), (0.5, -1.), grad=True))
+
+
+def test_psf_pickle():
+    """PSFs sent to worker processes give the same results."""
+
+    import multiprocessing
+
+    alpha = np.array([2.2, 2.0, 1.9, 1.8])
+    sigma, beta, eta = snf_tied_params(alpha)
+    args = (sigma, alpha, beta, np.array([1.0, 1.2, 1.5, 2.0]), eta,
+            np.array([0., 0.5, 1.0, 1.5]), np.array([0., -0.5, 0.25, 1.5]),
+            (32, 32))
+    A = cubefit.psffuncs.gaussian_moffat_psf(*args)
+    templates = cubefit.PSFTemplates(snf_tied_params, oversample=4,
+                                     radius=8)
+    psfs = [cubefit.TabularPSF(A, threads=1),
+            cubefit.TabularPSF(A, threads=1, sampling='dft',
+                               dtype=np.float32),
+            cubefit.GaussianMoffatPSF(*args, threads=1, method='integrate'),
+            cubefit.GaussianMoffatPSF(*args, threads=1, templates=templates),
+            cubefit.GaussianMoffatPSF(*args, threads=1, compress=1.e-4)]
+
+    np.random.seed(0)
+    galaxy = np.random.rand(4, 32, 32)
+
+    # caches are not pickled
+    psfs[0].cache_galaxy(galaxy)
+    assert pickle.loads(pickle.dumps(psfs[0]))._galcache is None
+    psfs[0].clear_galaxy_cache()
+
+    pool = multiprocessing.Pool(2)
+    try:
+        results = pool.map(_psf_results, [(psf, galaxy) for psf in psfs])
+    finally:
+        pool.close()
+        pool.join()
+
+    for psf, res in zip(psfs, results):
+        expected = _psf_results((psf, galaxy))
+        for (a, agrad), (b, bgrad) in zip(res, expected):
+            assert_allclose(a, b, rtol=1.e-12, atol=1.e-15)
+            assert_allclose(agrad, bgrad, rtol=1.e-12, atol=1.e-15)
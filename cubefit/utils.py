@@ -76,11 +76,15 @@ def yxbounds(shape1, shape2):
     return (-yd, yd), (-xd, xd)
 
 
-def fft_shift_phasor(n, d, grad=False):
+def fft_shift_phasor(n, d, grad=False, half=False):
     """Return a 1-d complex array of length `n` that, when mulitplied
     element-wise by another array in Fourier space, results in a shift
     by `d` in real space.
 
+    If `half` is True, the phasor is returned for the non-negative
+    frequencies of a real-input transform only (length ``n//2 + 1``,
+    matching the last axis of ``numpy.fft.rfft``).
+
     Notes
     -----
 
@@ -126,16 +130,21 @@ def fft_shift_phasor(n, d, grad=False):
     # fftfreq() gives frequency corresponding to each array element in
     # an FFT'd array (between -0.5 and 0.5). Multiplying by 2pi expands
     # this to (-pi, pi). Finally multiply by offset in array elements.
-    f = 2. * np.pi * fft.fftfreq(n) * (d % n)
+    #
+    # For `half`, rfftfreq() gives the non-negative frequencies only; the
+    # Nyquist element (if any) is then the last one rather than -0.5, but
+    # its real part (all that we keep, see above) is the same.
+    freq = fft.rfftfreq(n) if half else fft.fftfreq(n)
+    f = 2. * np.pi * freq * (d % n)
 
     result = np.cos(f) - 1j*np.sin(f)  # or equivalently: np.exp(-1j * f)
 
     # This is where we set the Nyquist frequency to be purely real (see above)
     if n % 2 == 0:
-        result[n/2] = np.real(result[n/2])
+        result[n//2] = np.real(result[n//2])
 
     if grad:
-        df = 2. * np.pi * fft.fftfreq(n)
+        df = 2. * np.pi * freq
         dresult = (-np.sin(f) -1j*np.cos(f)) * df
         if n % 2 == 0:
             dresult[n//2] = np.real(dresult[n//2])
@@ -144,7 +153,7 @@ def fft_shift_phasor(n, d, grad=False):
     else:
         return result
 
-def fft_shift_phasor_2d(shape, offset, grad=False):
+def fft_shift_phasor_2d(shape, offset, grad=False, half=False):
     """Return phasor array used to shift an array (in real space) by
     multiplication in fourier space.
     
@@ -154,11 +163,16 @@ def fft_shift_phasor_2d(shape, offset, grad=False):
         Length 2 iterable giving shape of array.
     offset : (float, float)
         Offset in array elements in each dimension.
+    half : bool, optional
+        If True, return the phasor for the half-spectrum produced by a
+        real-input transform (``numpy.fft.rfft2``), with shape
+        ``(ny, nx//2 + 1)``.
 
     Returns
     -------
     z : np.ndarray (complex; 2-d)
-        Complex array with shape ``shape``.
+        Complex array with shape ``shape`` (or ``(ny, nx//2 + 1)`` if
+        `half` is True).
 
     """
     
@@ -166,7 +180,7 @@ def fft_shift_phasor_2d(shape, offset, grad=False):
     dy, dx = offset
 
     yphasor = fft_shift_phasor(ny, dy, grad=grad)
-    xphasor = fft_shift_phasor(nx, dx, grad=grad)
+    xphasor = fft_shift_phasor(nx, dx, grad=grad, half=half)
 
     if grad:
         res = np.outer(yphasor[0], xphasor[0])
@@ -177,3 +191,57 @@ def fft_shift_phasor_2d(shape, offset, grad=False):
 
     else:
         return np.outer(yphasor, xphasor)
+
+
+def idft_matrix(n, m, half=False):
+    """Matrix evaluating the first `m` elements of a (normalized) inverse
+    DFT of length `n`.
+
+    Multiplying a Fourier-space vector by this matrix is equivalent to
+    ``numpy.fft.ifft(z)[0:m]`` but only evaluates the needed outputs.
+
+    Parameters
+    ----------
+    n : int
+        Length of transform.
+    m : int
+        Number of output elements.
+    half : bool, optional
+        If True, the input is the half spectrum (length ``n//2 + 1``) of a
+        real-valued array, as from ``numpy.fft.rfft``, and the *real part*
+        of the product is equivalent to ``numpy.fft.irfft(z, n)[0:m]``.
+
+    Returns
+    -------
+    a : np.ndarray (complex; 2-d)
+        Shape is (m, n) or (m, n//2 + 1) if `half` is True.
+    """
+
+    k = np.arange(n // 2 + 1) if half else np.arange(n)
+    a = np.exp((2j * np.pi / n) * np.outer(np.arange(m), k)) / n
+
+    # In the half spectrum, each frequency other than 0 (and n/2 if n is
+    # even) stands for itself and its negative, whose contribution to the
+    # real part is the same.
+    if half:
+        a[:, 1:(n + 1) // 2] *= 2.
+
+    return a
+
+
+def dft_matrix(n, m, half=False):
+    """Matrix evaluating the DFT of length `n` of an array whose only
+    nonzero elements are the first `m`.
+
+    Multiplying a length-`m` vector by this matrix is equivalent to
+    ``numpy.fft.fft(x, n)`` (or ``numpy.fft.rfft(x, n)`` if `half` is
+    True).
+
+    Returns
+    -------
+    a : np.ndarray (complex; 2-d)
+        Shape is (n, m) or (n//2 + 1, m) if `half` is True.
+    """
+
+    k = np.arange(n // 2 + 1) if half else np.arange(n)
+    return np.exp((-2j * np.pi / n) * np.outer(k, np.arange(m)))
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
+import glob
 import os
 import sys
 
 from setuptools import setup
 from setuptools.extension import Extension
+from setuptools.command.build_ext import build_ext
 from setuptools.command.test import test as TestCommand
 
 import numpy
@@ -12,21 +14,54 @@ import numpy
 with open('cubefit/version.py') as f:
     exec(f.read())
 
-fname = os.path.join("cubefit", "psffuncs.pyx")
+fname = os.path.join("cubefit", "_psffuncs.pyx")
 USE_CYTHON = True
 if not os.path.exists(fname):
     fname = fname.replace(".pyx", ".c")
     USE_CYTHON = False
 
-exts = [Extension("cubefit.psffuncs", [fname],
+# The PSF kernel is parallelized over wavelength with OpenMP. Set the
+# environment variable CUBEFIT_NO_OPENMP to build without it (e.g., with
+# compilers that do not support OpenMP); the kernel then runs serially.
+if os.environ.get("CUBEFIT_NO_OPENMP"):
+    openmp_args = []
+elif sys.platform == "win32":
+    openmp_args = ["/openmp"]
+else:
+    openmp_args = ["-fopenmp"]
+
+# The extension is optional: if it fails to build, `cubefit.psffuncs`
+# falls back to a (slower) NumPy implementation.
+exts = [Extension("cubefit._psffuncs", [fname],
                   include_dirs=[numpy.get_include()],
-                  libraries=["m"])]
+                  libraries=["m"],
+                  extra_compile_args=openmp_args,
+                  extra_link_args=openmp_args,
+                  optional=True)]
 
 if USE_CYTHON:
     from Cython.Build import cythonize
     exts = cythonize(exts)
 
 
+class BuildExt(build_ext):
+    """Removes the extension module of earlier versions before building.
+
+    The compiled module used to be `cubefit.psffuncs`, which is now a
+    pure-Python module that dispatches to `cubefit._psffuncs`. An old
+    `cubefit/psffuncs.*.so` left by an in-place build would take
+    priority over it on import.
+    """
+
+    def run(self):
+        for suffix in (".so", ".pyd"):
+            pattern = os.path.join("cubefit", "psffuncs*" + suffix)
+            for fname in glob.glob(pattern):
+                print("removing stale extension module " + fname)
+                os.remove(fname)
+        build_ext.run(self)
+
+
 class PyTest(TestCommand):
     """Enables setup.py test"""
 
@@ -58,5 +93,5 @@ setup(name="cubefit",
       scripts=['scripts/cubefit',
                'scripts/cubefit-subtract',
                'scripts/cubefit-plot'],
-      cmdclass={'test': PyTest}
+      cmdclass={'build_ext': BuildExt, 'test': PyTest}
   )